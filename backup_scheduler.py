@@ -0,0 +1,216 @@
+import heapq
+from datetime import datetime
+from os import path
+from threading import Thread, Lock
+
+from backuper import Backuper
+from bandwidth_governor import BandwidthGovernor
+from media_store import MediaStore
+from rate_governor import RateGovernor
+
+
+class BackupScheduler:
+    """Backups many dialogs at once, running a bounded amount of Backupers
+       concurrently. All of them share the same RateGovernor and BandwidthGovernor
+       (and thus the same request and byte budgets) and the same MediaStore (so
+       every stored file is only verified once per run), and those dialogs with more
+       new content are backed up first. Since every Backuper resumes from its own
+       metadata, restarting the scheduler simply continues where it was left"""
+
+    #region Initialization
+
+    def __init__(self, client, max_workers=4, max_dialogs=10000,
+                 request_budget=None, rate_governor=None,
+                 byte_budget=None, bandwidth_governor=None, media_backup=None, media_store=None):
+        """
+        :param client:             An initialized TelegramClient, shared by all the Backupers
+        :param max_workers:        How many dialogs can be backed up at the same time
+        :param max_dialogs:        How many dialogs should be retrieved at most
+        :param request_budget:     If specified, no more requests than these will be made to Telegram.
+                                   The backups left will continue on the next run
+        :param rate_governor:      The RateGovernor all the Backupers will be paced by
+        :param byte_budget:        If specified, no more media bytes than these will be downloaded.
+                                   The backups left will continue on the next run
+        :param bandwidth_governor: The BandwidthGovernor all the media downloads draw their bytes from
+        :param media_backup:       If specified, the media of every dialog is also backed up after its
+                                   messages, with these arguments (see Backuper.start_media_backup)
+        :param media_store:        The MediaStore shared by all the Backupers. By default,
+                                   the one under Backuper.backups_dir is used
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self.max_dialogs = max_dialogs
+        self.request_budget = request_budget
+        self.rate_governor = rate_governor if rate_governor else RateGovernor()
+        self.byte_budget = byte_budget
+        self.bandwidth_governor = bandwidth_governor if bandwidth_governor else BandwidthGovernor()
+        self.media_backup = media_backup
+        self.media_store = media_store if media_store else \
+            MediaStore(path.join(Backuper.backups_dir, 'store'))
+
+        # Heap of (-priority, order, entity), so the dialogs with more new content come first.
+        # The Backupers are only made once their dialog is about to be backed up, since
+        # making one already involves saving the entity and opening its database
+        self.pending = []
+        self.running = {}
+        self.done = []
+        self.skipped = []
+
+        self.lock = Lock()
+        self.workers = []
+
+        # Is the scheduler running (are dialogs being backed up?)
+        self.scheduler_running = False
+
+        # Used to calculate the aggregated progress
+        self.start_time = None
+        self.start_requests = 0
+        self.start_bytes = 0
+
+    #endregion
+
+    #region Planning
+
+    def enumerate_dialogs(self):
+        """Enumerates the (dialog, entity) pairs of the current user"""
+        dialogs, entities = self.rate_governor.invoke(self.client.get_dialogs, self.max_dialogs)
+        return zip(dialogs, entities)
+
+    @staticmethod
+    def get_priority(dialog, metadata):
+        """Estimates how much new content the given dialog has, based on the
+           metadata of its backup (how many messages we don't have yet)"""
+        new_msgs = dialog.top_message - metadata.get('last_msg_id', 0)
+        missing_msgs = metadata.get('total_msgs', 0) - metadata.get('saved_msgs', 0)
+        return max(new_msgs, 0) + max(missing_msgs, 0)
+
+    def plan(self):
+        """Enumerates the dialogs and queues them by priority.
+           Those dialogs which have no new content are skipped"""
+        with self.lock:
+            self.pending.clear()
+            self.skipped.clear()
+            for order, (dialog, entity) in enumerate(self.enumerate_dialogs()):
+                if not Backuper.is_backup_dirty(entity.id, dialog.top_message):
+                    self.skipped.append(entity)
+                    continue
+
+                metadata = Backuper.read_exported_metadata(entity.id) or {}
+                priority = self.get_priority(dialog, metadata)
+                heapq.heappush(self.pending, (-priority, order, entity))
+
+    #endregion
+
+    #region Running
+
+    def start(self):
+        """Plans and begins the backup of all the dialogs"""
+        self.plan()
+
+        self.scheduler_running = True
+        self.start_time = datetime.now()
+        self.start_requests = self.rate_governor.requests
+        self.start_bytes = self.bandwidth_governor.downloaded_bytes
+
+        self.workers = [Thread(target=self.worker_thread) for _ in range(self.max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """Stops the scheduler and all the backups currently running"""
+        self.scheduler_running = False
+        with self.lock:
+            for backuper in self.running.values():
+                backuper.stop_backup()
+
+    def wait(self):
+        """Waits until all the workers have finished"""
+        for worker in self.workers:
+            worker.join()
+
+    def is_running(self):
+        """Determines whether any worker is still running"""
+        return any(worker.is_alive() for worker in self.workers)
+
+    def is_budget_exhausted(self):
+        """Determines whether we've already made all the requests
+           or downloaded all the bytes we were allowed to"""
+        if self.request_budget is not None and \
+                self.rate_governor.requests - self.start_requests >= self.request_budget:
+            return True
+
+        return self.byte_budget is not None and \
+            self.bandwidth_governor.downloaded_bytes - self.start_bytes >= self.byte_budget
+
+    def on_backup_progress(self, backuper):
+        """Called after every chunk saved (or media progress reported) by the given backuper"""
+        if not self.scheduler_running or self.is_budget_exhausted():
+            backuper.stop_backup()
+
+    def worker_thread(self):
+        """Backups the pending dialogs, one after another, until there are no more"""
+        while self.scheduler_running and not self.is_budget_exhausted():
+            with self.lock:
+                if not self.pending:
+                    break
+                entity = heapq.heappop(self.pending)[2]
+
+            try:
+                backuper = Backuper(self.client, entity, rate_governor=self.rate_governor,
+                                    bandwidth_governor=self.bandwidth_governor,
+                                    media_store=self.media_store)
+            except Exception as e:
+                print('Error preparing the backup of {}: {}'.format(entity.id, e))
+                continue
+
+            with self.lock:
+                self.running[entity.id] = backuper
+
+            backuper.on_metadata_change = lambda: self.on_backup_progress(backuper)
+            try:
+                # If we have the whole history, we only need to ask for the newer messages
+                if backuper.has_full_history():
+                    backuper.sync_messages_thread()
+                else:
+                    backuper.backup_messages_thread()
+
+                if self.media_backup and self.scheduler_running and not self.is_budget_exhausted():
+                    backuper.backup_media_thread(**dict(
+                        self.media_backup,
+                        progress_callback=lambda *_: self.on_backup_progress(backuper)))
+            except Exception as e:
+                print('Error backing up {}: {}'.format(entity.id, e))
+            finally:
+                backuper.on_metadata_change = None
+                with self.lock:
+                    del self.running[entity.id]
+                    self.done.append(backuper)
+
+    #endregion
+
+    #region Progress
+
+    def get_progress(self):
+        """Returns a dictionary with the aggregated progress of all the backups
+           (dialogs_done, dialogs_running, dialogs_pending, dialogs_skipped,
+            saved_msgs, msgs_per_sec, elided_writes, downloaded_bytes)"""
+        with self.lock:
+            saved_msgs = sum(b.saved_msgs_now for b in self.done) + \
+                         sum(b.saved_msgs_now for b in self.running.values())
+
+            # The running backups only report this once they finish
+            elided_writes = sum(b.elided_writes for b in self.done)
+
+            elapsed = (datetime.now() - self.start_time).total_seconds() if self.start_time else 0
+            return {
+                'dialogs_done': len(self.done),
+                'dialogs_running': len(self.running),
+                'dialogs_pending': len(self.pending),
+                'dialogs_skipped': len(self.skipped),
+                'saved_msgs': saved_msgs,
+                'msgs_per_sec': round(saved_msgs / elapsed, 2) if elapsed else 0,
+                'elided_writes': elided_writes,
+                'downloaded_bytes': self.bandwidth_governor.downloaded_bytes - self.start_bytes
+            }
+
+    #endregion
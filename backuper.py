@@ -1,19 +1,29 @@
 import json
 import shutil
 from datetime import timedelta, datetime
-from os import path, listdir, remove
+from time import monotonic
+from os import path, listdir, remove, replace
 from os.path import isfile, isdir
-from threading import Thread
-from time import sleep
+from queue import Queue, Full
+from threading import Thread, Lock
 
 import telethon.tl.all_tlobjects as all_tlobjects
-from telethon.errors import RPCError, TypeNotFoundError
+from telethon import TelegramBareClient
+from telethon.crypto import CdnDecrypter
+from telethon.errors import TypeNotFoundError, FileMigrateError
 from telethon.tl.functions.messages import GetHistoryRequest
-from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument
+from telethon.tl.functions.upload import GetFileRequest
+from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument, \
+    InputFileLocation, InputDocumentFileLocation
 from telethon.tl.types.messages import Messages, MessagesSlice, ChannelMessages
+from telethon.tl.types.upload import FileCdnRedirect
 from telethon.extensions import BinaryReader, BinaryWriter
 
+from bandwidth_governor import BandwidthGovernor
+from eta_estimator import EtaEstimator
 from media_handler import MediaHandler
+from media_store import MediaStore
+from rate_governor import RateGovernor
 from tl_database import TLDatabase
 
 scheme_layer = all_tlobjects.layer
@@ -27,30 +37,81 @@ class Backuper:
     # Default output directory for all the made backups
     backups_dir = 'backups'
 
+    # The size of every part requested when downloading documents. Telegram requires
+    # it to be divisible by 4 KB, and that 1 MB is divisible by it
+    download_part_size = 128 * 1024
+
+    # How many files of every media kind are downloaded at the same time by default
+    media_workers = {
+        'propics': 1,
+        'photos': 4,
+        'docs': 2
+    }
+
+    # How many times per second the media backup progress is reported at most
+    media_progress_rate = 4
+
+    # How many seconds the media feeders wait for room in the queue before
+    # checking again whether the backup is still running
+    media_put_timeout = 1
+
     #region Initialize
 
     def __init__(self, client, entity,
                  download_delay=1,
-                 download_chunk_size=100):
+                 download_chunk_size=100,
+                 max_pending_chunks=2,
+                 rate_governor=None,
+                 metadata_export_interval=60,
+                 media_store=None,
+                 bandwidth_governor=None,
+                 storage_profile='default'):
         """
         :param client:              An initialized TelegramClient, which will be used to download the messages
         :param entity:              The entity (user, chat or channel) from which the backup will be made
-        :param download_delay:      The download delay, in seconds, after a message chunk is downloaded
+        :param download_delay:      The initial delay, in seconds, between requests. It adapts
+                                    over time, and it's ignored if a rate_governor is given
         :param download_chunk_size: The chunk size (i.e. how many messages do we download every time)
                                     The maximum allowed by Telegram is 100
+        :param max_pending_chunks:  How many downloaded message chunks may be waiting to be
+                                    saved to the database before downloading is paused
+        :param rate_governor:       The RateGovernor all the requests will be paced by. It should
+                                    be shared between all the Backupers using the same client
+        :param metadata_export_interval: The metadata is always saved in the database, alongside the
+                                         messages. This determines every how many seconds it's also
+                                         exported to metadata.json (None to never export it)
+        :param media_store:         The MediaStore shared by all the backups, which is consulted before
+                                    downloading any media. By default, the one under backups_dir is used
+        :param bandwidth_governor:  The BandwidthGovernor all the media downloads draw their bytes from.
+                                    It should be shared between all the Backupers downloading media.
+                                    By default, the bandwidth is not capped
+        :param storage_profile:     The TLDatabase storage profile the messages are saved with.
+                                    'bulk' is faster, but the database may be corrupted if the
+                                    operating system crashes or there is a power loss
         """
         self.client = client
         self.entity = entity
 
         self.download_delay = download_delay
+        if not rate_governor:
+            rate_governor = RateGovernor(rate=1 / max(download_delay, 0.1))
+        self.rate_governor = rate_governor
         self.download_chunk_size = download_chunk_size
+        self.max_pending_chunks = max_pending_chunks
 
         self.backup_dir = path.join(Backuper.backups_dir, str(entity.id))
         self.media_handler = MediaHandler(self.backup_dir)
+        self.media_store = media_store if media_store else \
+            MediaStore(path.join(Backuper.backups_dir, 'store'))
+        self.bandwidth_governor = bandwidth_governor if bandwidth_governor else BandwidthGovernor()
+        self.storage_profile = storage_profile
 
         # Open and close the database to create the require directories
         TLDatabase(self.backup_dir).close()
 
+        self.metadata_export_interval = metadata_export_interval
+        self.last_metadata_export = 0
+
         # Set up all the directories and files that we'll be needing
         self.files = {
             'entity': path.join(self.backup_dir, 'entity.tlo'),
@@ -61,6 +122,12 @@ class Backuper:
         # Is the backup running (are messages being downloaded?)
         self.backup_running = False
 
+        # How many messages have been saved since the last backup was started
+        self.saved_msgs_now = 0
+
+        # How many user and chat writes were skipped because they didn't change
+        self.elided_writes = 0
+
         # Event that gets fired when metadata is saved
         self.on_metadata_change = None
 
@@ -74,32 +141,95 @@ class Backuper:
 
     #region Metadata handling
 
-    def save_metadata(self):
-        """Saves the metadata for the current entity"""
-        with open(self.files['metadata'], 'w', encoding='utf-8') as file:
-            json.dump(self.metadata, file)
+    def save_metadata(self, db=None, force_export=False):
+        """Saves the metadata for the current entity.
+
+           If a database is given, the metadata is saved as part of its current
+           transaction, which is then committed (so the data and the metadata are
+           committed together). Otherwise, the database is opened and the metadata
+           committed right away.
+
+           Only once the metadata has been committed, the metadata.json file is
+           exported (every metadata_export_interval seconds, unless force_export
+           is given) and on_metadata_change is called, so neither of them can
+           ever be ahead of what the database has"""
+        if db:
+            db.set_metadata(self.metadata)
+            db.commit()
+        else:
+            with TLDatabase(self.backup_dir) as db:
+                db.set_metadata(self.metadata)
+                db.commit()
+
+        if self.metadata_export_interval is not None and \
+                (force_export or monotonic() - self.last_metadata_export >= self.metadata_export_interval):
+            self.export_metadata()
 
         if self.on_metadata_change:
             self.on_metadata_change()
 
+    def export_metadata(self):
+        """Exports the metadata for the current entity to its metadata.json file"""
+        with open(self.files['metadata'], 'w', encoding='utf-8') as file:
+            json.dump(self.metadata, file)
+
+        self.last_metadata_export = monotonic()
+
     def load_metadata(self):
         """Loads the metadata of the current entity"""
-        if not path.isfile(self.files['metadata']):
+        with TLDatabase(self.backup_dir) as db:
+            metadata = db.get_metadata()
+
+        if not metadata:
+            # Older backups only had their metadata saved in metadata.json
+            metadata = self.read_metadata(self.files['metadata'])
+
+        if not metadata:
             return {
                 'resume_msg_id': 0,
+                'last_msg_id': 0,
                 'saved_msgs': 0,
                 'total_msgs': 0,
                 'etl': '???',
                 'scheme_layer': scheme_layer
             }
         else:
-            with open(self.files['metadata'], 'r', encoding='utf-8') as file:
+            return metadata
+
+    @staticmethod
+    def read_metadata(metadata_file):
+        """Reads the given metadata file, or returns None if it doesn't exist"""
+        if path.isfile(metadata_file):
+            with open(metadata_file, 'r', encoding='utf-8') as file:
                 return json.load(file)
 
+    @staticmethod
+    def read_exported_metadata(entity_id):
+        """Reads the exported metadata file of the backup for the given entity ID,
+           or returns None if it doesn't exist. Unlike load_metadata(), no database
+           is opened, which makes this cheap enough to be ran for every dialog"""
+        return Backuper.read_metadata(path.join(Backuper.backups_dir, str(entity_id), 'metadata.json'))
+
+    @staticmethod
+    def is_backup_dirty(entity_id, top_message):
+        """Determines whether the backup for the given entity ID is missing messages,
+           given the ID of the latest message in its dialog (`dialog.top_message`).
+
+           Only the exported metadata file is read, so no request is made and no
+           database is opened, which makes this cheap enough to be ran for every dialog.
+           If the metadata file isn't exported, the backup is always considered dirty"""
+        metadata = Backuper.read_exported_metadata(entity_id)
+        if not metadata:
+            return True
+
+        # Old backups don't know which their latest message is, so we need to check them
+        return metadata.get('last_msg_id', 0) < top_message or \
+            metadata['saved_msgs'] < metadata['total_msgs']
+
     def update_total_messages(self):
         """Updates the total messages with the current peer"""
 
-        result = self.client.invoke(GetHistoryRequest(
+        result = self.rate_governor.invoke(self.client.invoke, GetHistoryRequest(
             peer=self.entity,
             # No offset, we simply want the total messages count
             offset_id=0, limit=0, offset_date=None,
@@ -157,6 +287,20 @@ class Backuper:
         """Begins the backup on the given peer"""
         Thread(target=self.backup_messages_thread).start()
 
+    def start_gaps_refill(self):
+        """Begins downloading the messages missing between those we have on the given peer"""
+        Thread(target=self.refill_gaps_thread).start()
+
+    def start_edits_resync(self, lookback=timedelta(days=2)):
+        """Begins updating the edited messages on the given peer,
+           only looking at the messages sent during the given lookback"""
+        Thread(target=self.resync_edits_thread, kwargs={'lookback': lookback}).start()
+
+    def start_sync(self):
+        """Begins the incremental backup on the given peer,
+           which only downloads the messages newer than those we have"""
+        Thread(target=self.sync_messages_thread).start()
+
     def start_media_backup(self, **kwargs):
         """Begins the media backup on the given peer.
            The valid named arguments are:
@@ -170,128 +314,470 @@ class Backuper:
            before_date: If specified, only media before this date will be downloaded
 
            progress_callback: If specified, current download progress will be reported here
-                              invoking progress_callback(saved bytes, total bytes, estimated time left)"""
+                              invoking progress_callback(saved bytes, total bytes, estimated time left).
+                              The bytes of the documents being downloaded are also reported as they
+                              arrive, but no more than Backuper.media_progress_rate times per second
+           workers: If specified, a {kind: count} dictionary determining how many files of
+                    every kind ('propics', 'photos' or 'docs') are downloaded at the same time
+           planner: If specified, the MediaPlanner determining in which order the media
+                    of all kinds is downloaded (for example, the newest first)"""
         Thread(target=self.backup_media_thread, kwargs=kwargs).start()
 
     def stop_backup(self):
         """Stops the backup (either messages or media) on the given peer"""
         self.backup_running = False
 
+    def is_backup_running(self):
+        """Determines whether the backup (either messages or media) is running"""
+        return self.backup_running
+
     #region Messages backup
 
     def backup_messages_thread(self):
-        """This method backups the messages and should be ran in a different thread"""
-        self.backup_running = True
-
-        # Create a connection to the database
-        db = TLDatabase(self.backup_dir)
+        """This method backups the messages and should be ran in a different thread.
 
-        # Determine whether we started making the backup from the very first message or not.
-        # If this is the case:
-        #   We won't need to come back to the first message again after we've finished downloading
-        #   them all, since that first message will already be in backup.
-        #
-        # Otherwise, if we did not start from the first message:
-        #   More messages were in the backup already, and after we backup those "left" ones,
-        #   we must return to the first message and backup until where we started.
-        started_at_0 = self.metadata['resume_msg_id'] == 0
+           The messages are only fetched here. Every fetched chunk is handed to a
+           writer thread through a bounded queue, so the next chunk is already being
+           downloaded while the previous one is persisted to the database"""
+        self.backup_running = True
 
-        # Keep an internal downloaded count for it to be faster
-        # (instead of querying the database all the time)
-        self.metadata['saved_msgs'] = db.count('messages')
+        # The writer thread owns the database and decides where we should keep fetching
+        # from. Whenever it changes our offset, it bumps the generation, so that chunks
+        # which were fetched speculatively with the old offset can be told apart
+        fetch_state = {
+            'offset_id': self.metadata['resume_msg_id'],
+            'generation': 0,
+            'done': False
+        }
+        fetch_lock = Lock()
 
-        # We also need to keep track of how many messages we've downloaded now
-        # in order to calculate the estimated time left properly
-        saved_msgs_now = 0
+        chunks = Queue(maxsize=self.max_pending_chunks)
+        writer = Thread(target=self.backup_messages_writer_thread,
+                        args=(chunks, fetch_state, fetch_lock))
+        writer.start()
 
         # Make the backup
         try:
             # We need this to invoke GetHistoryRequest
             input_peer = self.entity
 
-            # Keep track from when we started to determine the estimated time left
-            start = datetime.now()
-
             # Enter the download-messages main loop
             self.client.connect()
-            while self.backup_running:
-                # Invoke the GetHistoryRequest to get the next messages after those we have
-                result = self.client.invoke(GetHistoryRequest(
+            while self.backup_running and writer.is_alive():
+                with fetch_lock:
+                    if fetch_state['done']:
+                        break
+                    offset_id = fetch_state['offset_id']
+                    generation = fetch_state['generation']
+
+                # Invoke the GetHistoryRequest to get the next messages after those we have.
+                # The rate governor makes sure Telegram won't get angry and tell us to chill
+                result = self.rate_governor.invoke(self.client.invoke, GetHistoryRequest(
                     peer=input_peer,
-                    offset_id=self.metadata['resume_msg_id'],
+                    offset_id=offset_id,
                     limit=self.download_chunk_size,
                     offset_date=None,
                     add_offset=0,
                     max_id=0,
                     min_id=0
-                ))
+                ), running=self.is_backup_running)
+                if result is None:
+                    # The backup was stopped while we were waiting
+                    break
+
                 # For some strange reason, GetHistoryRequest might return upload.file.File
                 # Ensure we retrieved Messages or MessagesSlice
                 if not isinstance(result, Messages) and not isinstance(result, MessagesSlice) \
                         and not isinstance(result, ChannelMessages):
                     print('Invalid result type when downloading messages:', type(result))
-                    sleep(self.download_delay)
+                    continue
+
+                # Walking backwards is deterministic, so we can already tell where the
+                # next chunk starts, unless the writer has changed our offset meanwhile
+                with fetch_lock:
+                    if generation == fetch_state['generation'] and result.messages:
+                        fetch_state['offset_id'] = result.messages[-1].id
+
+                # This blocks while the writer is behind (backpressure)
+                chunks.put((generation, result))
+
+                if not result.messages:
+                    # Only the writer knows whether we're done or must start over,
+                    # so wait until it's done with everything we've handed it
+                    chunks.join()
+
+            pass  # end while
+
+        except KeyboardInterrupt:
+            print('Operation cancelled, not downloading more messages!')
+
+        finally:
+            # Let the writer persist whatever we already fetched, and wait for it
+            chunks.put(None)
+            writer.join()
+            self.backup_running = False
+
+    def backup_messages_writer_thread(self, chunks, fetch_state, fetch_lock):
+        """Persists the message chunks fetched by backup_messages_thread until
+           None is received. The metadata is only updated after the chunk has
+           been committed, so resuming is correct even if we lag behind"""
+
+        # If writing fails (even before we started), we still need
+        # to consume the queue or the fetcher would block forever
+        db = None
+        failed = False
+        try:
+            # Create a connection to the database
+            db = TLDatabase(self.backup_dir, storage_profile=self.storage_profile)
+
+            # Determine whether we started making the backup from the very first message or not.
+            # If this is the case:
+            #   We won't need to come back to the first message again after we've finished downloading
+            #   them all, since that first message will already be in backup.
+            #
+            # Otherwise, if we did not start from the first message:
+            #   More messages were in the backup already, and after we backup those "left" ones,
+            #   we must return to the first message and backup until where we started.
+            started_at_0 = self.metadata['resume_msg_id'] == 0
+
+            # Keep an internal downloaded count for it to be faster
+            # (instead of querying the database all the time)
+            self.metadata['saved_msgs'] = db.count('messages')
+
+            # We also need to keep track of how many messages we've downloaded now
+            self.saved_msgs_now = 0
+
+            # Keep track of how fast we're saving messages to determine the estimated time left
+            estimator = EtaEstimator(total_items=self.metadata['total_msgs'],
+                                     done_items=self.metadata['saved_msgs'])
+
+        except Exception as e:
+            print('Error opening the database:', e)
+            failed = True
+            self.backup_running = False
+            if db:
+                db.close()
+                db = None
+
+        try:
+            while True:
+                item = chunks.get()
+                try:
+                    if item is None:
+                        break
+
+                    generation, result = item
+                    with fetch_lock:
+                        # Skip the chunks fetched before we changed the offset, or after we finished
+                        if failed or fetch_state['done'] or generation != fetch_state['generation']:
+                            continue
+
+                    self.metadata['total_msgs'] = getattr(result, 'count', len(result.messages))
+
+                    # First add users and chats, replacing any previous value
+                    db.add_objects(result.users, replace=True)
+                    db.add_objects(result.chats, replace=True)
+
+                    # Then add the messages to the backup, finding out
+                    # which of them we already had with a single query
+                    saved_ids = db.which_in_table((msg.id for msg in result.messages), 'messages')
+                    new_msgs = []
+                    for msg in result.messages:
+                        if msg.id in saved_ids:
+                            # If the message we retrieved was already saved, this means that we're
+                            # done because we have the rest of the messages.
+                            # Clear the list so we enter the next if, and break to early terminate
+                            self.metadata['resume_msg_id'] = result.messages[-1].id
+                            del result.messages[:]
+                            break
+                        else:
+                            new_msgs.append(msg)
+                            self.metadata['resume_msg_id'] = msg.id
+
+                    db.add_objects(new_msgs)
+                    self.saved_msgs_now += len(new_msgs)
+                    self.metadata['saved_msgs'] += len(new_msgs)
+                    if new_msgs:
+                        # Remember the newest message we have, to tell whether there's new content
+                        self.metadata['last_msg_id'] = max(self.metadata.get('last_msg_id', 0),
+                                                           max(msg.id for msg in new_msgs))
+
+                    estimator.total_items = self.metadata['total_msgs']
+                    estimator.update(items=len(new_msgs))
+                    self.metadata['etl'] = str(self.calculate_etl(
+                        self.metadata['saved_msgs'], self.metadata['total_msgs'],
+                        estimator=estimator))
+
+                    # Always commit at the end to save changes (and the metadata alongside them)
+                    self.save_metadata(db)
+
+                    # The list can be empty because we've either used a too big offset
+                    # (in which case we have all the previous messages), or we've reached
+                    # a point where we have the upcoming messages (so there's no need to
+                    # download them again and we stopped)
+                    if not result.messages:
+                        # We've downloaded all the messages since the last backup
+                        if started_at_0:
+                            # And since we started from the very first message, we have them all
+                            print('Downloaded all {}'.format(self.metadata['total_msgs']))
+                            with fetch_lock:
+                                fetch_state['done'] = True
+                        else:
+                            # We need to start from the first message (latest sent message)
+                            # and backup again until we have them all
+                            self.metadata['resume_msg_id'] = 0
+                            started_at_0 = True
+                            with fetch_lock:
+                                fetch_state['offset_id'] = 0
+                                fetch_state['generation'] += 1
+
+                except Exception as e:
+                    print('Error saving messages:', e)
+                    # Forget about the chunk which couldn't be saved, and its metadata
+                    db.rollback()
+                    self.metadata.update(db.get_metadata())
+                    failed = True
+                    self.backup_running = False
+
+                finally:
+                    chunks.task_done()
+
+        finally:
+            if db:
+                # Also commit here, we don't want to lose any information!
+                self.save_metadata(db, force_export=True)
+                self.elided_writes = db.elided_writes
+                db.close()
+
+    #endregion
+
+    #region Incremental messages backup
+
+    def has_full_history(self):
+        """Determines whether the previous backups reached the very first message,
+           in which case only the newer messages are left to be downloaded"""
+        return self.metadata.get('last_msg_id', 0) != 0 and \
+            self.metadata['saved_msgs'] >= self.metadata['total_msgs']
+
+    def sync_messages_thread(self):
+        """This method backups only the messages newer than the latest saved
+           one, and should be ran in a different thread.
+
+           Unlike backup_messages_thread, this never walks the history backwards:
+           every chunk is asked with min_id set to the latest saved message, and
+           we walk forward from it, so only the chunks with new messages are fetched.
+           Since we walk forward, the saved messages never have holes if stopped"""
+        self.backup_running = True
+
+        # Create a connection to the database
+        db = TLDatabase(self.backup_dir, storage_profile=self.storage_profile)
+        self.metadata['saved_msgs'] = db.count('messages')
+        self.saved_msgs_now = 0
+
+        try:
+            last_msg_id = db.get_max_id('messages')
+            estimator = EtaEstimator(total_items=self.metadata['total_msgs'],
+                                     done_items=self.metadata['saved_msgs'])
+
+            self.client.connect()
+            while self.backup_running:
+                # Using offset_id=last+1 and a negative add_offset of the chunk size
+                # returns the chunk right after (newer than) our latest message,
+                # and min_id ensures that we never get the messages we already have
+                result = self.rate_governor.invoke(self.client.invoke, GetHistoryRequest(
+                    peer=self.entity,
+                    offset_id=last_msg_id + 1,
+                    limit=self.download_chunk_size,
+                    offset_date=None,
+                    add_offset=-self.download_chunk_size,
+                    max_id=0,
+                    min_id=last_msg_id
+                ), running=self.is_backup_running)
+                if result is None:
+                    # The backup was stopped while we were waiting
+                    break
+
+                if not isinstance(result, Messages) and not isinstance(result, MessagesSlice) \
+                        and not isinstance(result, ChannelMessages):
+                    print('Invalid result type when downloading messages:', type(result))
                     continue
 
                 self.metadata['total_msgs'] = getattr(result, 'count', len(result.messages))
 
                 # First add users and chats, replacing any previous value
-                for user in result.users:
-                    db.add_object(user, replace=True)
-                for chat in result.chats:
-                    db.add_object(chat, replace=True)
-
-                # Then add the messages to the backup
-                for msg in result.messages:
-                    if db.in_table(msg.id, 'messages'):
-                        # If the message we retrieved was already saved, this means that we're
-                        # done because we have the rest of the messages.
-                        # Clear the list so we enter the next if, and break to early terminate
-                        self.metadata['resume_msg_id'] = result.messages[-1].id
-                        del result.messages[:]
+                db.add_objects(result.users, replace=True)
+                db.add_objects(result.chats, replace=True)
+
+                # Then add the messages to the backup, all of which are new
+                db.add_objects(result.messages)
+                self.saved_msgs_now += len(result.messages)
+                self.metadata['saved_msgs'] += len(result.messages)
+                if result.messages:
+                    last_msg_id = max(msg.id for msg in result.messages)
+                    self.metadata['last_msg_id'] = max(self.metadata.get('last_msg_id', 0), last_msg_id)
+
+                estimator.total_items = self.metadata['total_msgs']
+                estimator.update(items=len(result.messages))
+                self.metadata['etl'] = str(self.calculate_etl(
+                    self.metadata['saved_msgs'], self.metadata['total_msgs'],
+                    estimator=estimator))
+
+                # Always commit at the end to save changes (and the metadata alongside them)
+                self.save_metadata(db)
+
+                # If the chunk wasn't full, there are no newer messages left
+                if len(result.messages) < self.download_chunk_size:
+                    print('Downloaded all {}'.format(self.metadata['total_msgs']))
+                    break
+
+        except KeyboardInterrupt:
+            print('Operation cancelled, not downloading more messages!')
+
+        finally:
+            # Always commit here, we don't want to lose any information!
+            self.save_metadata(db, force_export=True)
+            self.elided_writes = db.elided_writes
+            db.close()
+            self.backup_running = False
+
+    #endregion
+
+    #region Gaps refill
+
+    def refill_gaps_thread(self):
+        """This method downloads only the messages missing between those we already
+           have (for example, if a backup died before saving its metadata, or if a
+           chunk was skipped), and should be ran in a different thread.
+
+           Every gap is requested with min_id and max_id bounds, so no message
+           outside it will be downloaded again. Once a gap has been walked through,
+           whatever is still missing in it was deleted, so it's marked as empty and
+           not requested again on later refills"""
+        self.backup_running = True
+
+        # Create a connection to the database
+        db = TLDatabase(self.backup_dir, storage_profile=self.storage_profile)
+        self.metadata['saved_msgs'] = db.count('messages')
+        self.saved_msgs_now = 0
+
+        try:
+            self.client.connect()
+            for first_id, last_id in db.find_gaps('messages', skip_empty=True):
+                # Both min_id and max_id are exclusive, and we walk backwards from the end
+                offset_id = 0
+                while self.backup_running:
+                    result = self.rate_governor.invoke(self.client.invoke, GetHistoryRequest(
+                        peer=self.entity,
+                        offset_id=offset_id,
+                        limit=self.download_chunk_size,
+                        offset_date=None,
+                        add_offset=0,
+                        max_id=last_id + 1,
+                        min_id=first_id - 1
+                    ), running=self.is_backup_running)
+                    if result is None:
+                        # The backup was stopped while we were waiting
                         break
-                    else:
-                        db.add_object(msg)
-                        saved_msgs_now += 1
-                        self.metadata['saved_msgs'] += 1
-                        self.metadata['resume_msg_id'] = msg.id
 
-                self.metadata['etl'] = str(self.calculate_etl(
-                    saved_msgs_now, self.metadata['total_msgs'],
-                    start=start))
+                    if not isinstance(result, Messages) and not isinstance(result, MessagesSlice) \
+                            and not isinstance(result, ChannelMessages):
+                        print('Invalid result type when downloading messages:', type(result))
+                        continue
 
-                # Always commit at the end to save changes
-                db.commit()
-                self.save_metadata()
+                    db.add_objects(result.users, replace=True)
+                    db.add_objects(result.chats, replace=True)
+                    db.add_objects(result.messages, replace=True)
+                    self.saved_msgs_now += len(result.messages)
+                    self.metadata['saved_msgs'] += len(result.messages)
 
-                # The list can be empty because we've either used a too big offset
-                # (in which case we have all the previous messages), or we've reached
-                # a point where we have the upcoming messages (so there's no need to
-                # download them again and we stopped)
-                if not result.messages:
-                    # We've downloaded all the messages since the last backup
-                    if started_at_0:
-                        # And since we started from the very first message, we have them all
-                        print('Downloaded all {}'.format(self.metadata['total_msgs']))
+                    # If the chunk wasn't full, there is nothing else in this gap
+                    gap_done = len(result.messages) < self.download_chunk_size
+                    if gap_done:
+                        db.add_empty_gap(first_id, last_id)
+
+                    self.save_metadata(db)
+                    if gap_done:
                         break
-                    else:
-                        # We need to start from the first message (latest sent message)
-                        # and backup again until we have them all
-                        self.metadata['resume_msg_id'] = 0
-                        started_at_0 = True
+                    offset_id = min(msg.id for msg in result.messages)
 
-                # Always sleep a bit, or Telegram will get angry and tell us to chill
-                sleep(self.download_delay)
+                if not self.backup_running:
+                    break
 
-            pass  # end while
+            print('Refilled {} missing messages'.format(self.saved_msgs_now))
 
         except KeyboardInterrupt:
             print('Operation cancelled, not downloading more messages!')
+
+        finally:
+            # Always commit here, we don't want to lose any information!
+            self.save_metadata(db, force_export=True)
+            self.elided_writes = db.elided_writes
+            db.close()
+            self.backup_running = False
+
+    #endregion
+
+    #region Edited messages resync
+
+    def resync_edits_thread(self, lookback=timedelta(days=2)):
+        """This method downloads again the messages sent during the given lookback
+           (a timedelta) and updates those which changed (i.e. were edited) since
+           they were saved. It should be ran in a different thread.
+
+           Only the changed messages are written, which is cheaply determined
+           by comparing their content hash, so unchanged chunks cost no writes"""
+        self.backup_running = True
+
+        # Create a connection to the database
+        db = TLDatabase(self.backup_dir, storage_profile=self.storage_profile)
+        updated_msgs = 0
+
+        try:
+            since = datetime.now() - lookback
+            offset_id = 0
+
+            self.client.connect()
+            while self.backup_running:
+                result = self.rate_governor.invoke(self.client.invoke, GetHistoryRequest(
+                    peer=self.entity,
+                    offset_id=offset_id,
+                    limit=self.download_chunk_size,
+                    offset_date=None,
+                    add_offset=0,
+                    max_id=0,
+                    min_id=0
+                ), running=self.is_backup_running)
+                if result is None:
+                    # The backup was stopped while we were waiting
+                    break
+
+                if not isinstance(result, Messages) and not isinstance(result, MessagesSlice) \
+                        and not isinstance(result, ChannelMessages):
+                    print('Invalid result type when downloading messages:', type(result))
+                    continue
+
+                # Messages come from newest to oldest, so we're done once they're too old
+                msgs = [msg for msg in result.messages if msg.date >= since]
+
+                db.add_objects(result.users, replace=True)
+                db.add_objects(result.chats, replace=True)
+                updated_msgs += db.replace_changed_messages(msgs)
+                db.commit()
+
+                if len(msgs) < self.download_chunk_size:
+                    break
+                offset_id = result.messages[-1].id
+
+            print('Updated {} edited messages'.format(updated_msgs))
+
+        except KeyboardInterrupt:
+            print('Operation cancelled, not updating more messages!')
             # Also commit here, we don't want to lose any information!
             db.commit()
-            self.save_metadata()
 
         finally:
+            self.elided_writes = db.elided_writes
+            db.close()
             self.backup_running = False
 
     #endregion
@@ -309,9 +795,10 @@ class Backuper:
         if filename:  # User may not have a profile picture
             if not isfile(filename):
                 # Only download the file if it doesn't exist yet
-                self.client.download_profile_photo(self.entity.photo,
-                                                   file_path=filename,
-                                                   add_extension=False)
+                self.rate_governor.invoke(self.client.download_profile_photo,
+                                          self.entity.photo,
+                                          file_path=filename,
+                                          add_extension=False)
                 # If we downloaded a new version, copy it to the "default" generic file
                 if isfile(generic_filename):
                     remove(generic_filename)
@@ -330,96 +817,494 @@ class Backuper:
             if dl_propics:
                 total_size += db.count('users where photo not null') * AVERAGE_PROPIC_SIZE
 
+            # The media sizes are stored in their own column, so there's no need to load the messages
             if dl_photos:
-                for msg in db.query_messages(self.get_query(MessageMediaPhoto, before_date, after_date)):
-                    total_size += msg.media.photo.sizes[-1].size
+                total_size += db.sum_column('media_size', 'messages {}'.format(
+                    self.get_query(MessageMediaPhoto, before_date, after_date, skip_downloaded=True)))
 
             if dl_docs:
-                for msg in db.query_messages(self.get_query(MessageMediaDocument, before_date, after_date)):
-                    if not docs_max_size or msg.media.document.size <= docs_max_size:
-                        total_size += msg.media.document.size
+                total_size += db.sum_column('media_size', 'messages {}'.format(
+                    self.get_query(MessageMediaDocument, before_date, after_date,
+                                   max_size=docs_max_size, skip_downloaded=True)))
 
             return total_size
 
+    def enumerate_media(self, db, kind, docs_max_size=None, before_date=None, after_date=None):
+        """Enumerates the media of the given kind (propics, photos or docs) which should be
+           downloaded, as dictionaries with the kind, the download function, the media, the
+           output file, its size in bytes, and for message media, the message ID, the media
+           ID and type, and its path relative to the backup directory.
+
+           The message media already downloaded (as told by the media manifest) is skipped.
+           The message media is enumerated by the datacenter it's stored in, so the workers
+           don't need to switch between the connections to different datacenters constantly"""
+        filters = self.get_media_filters(kind, docs_max_size, before_date, after_date)
+        if kind == 'propics':
+            # TODO Also query chats and channels
+            tlobjects = db.query_users(filters)
+        else:
+            tlobjects = db.query_messages(filters + ' order by media_dc_id')
+
+        for tlobject in tlobjects:
+            item = self.get_media_item(kind, tlobject)
+            if item:
+                yield item
+
+    def get_media_filters(self, kind, docs_max_size=None, before_date=None, after_date=None):
+        """Returns the filters for the users (if the kind is propics) or the
+           messages (otherwise) whose media of the given kind should be downloaded"""
+        if kind == 'propics':
+            return 'where photo not null'
+
+        if kind == 'photos':
+            return self.get_query(MessageMediaPhoto, before_date, after_date, skip_downloaded=True)
+
+        return self.get_query(MessageMediaDocument, before_date, after_date,
+                              max_size=docs_max_size, skip_downloaded=True)
+
+    def get_media_item(self, kind, tlobject):
+        """Returns the dictionary used by enumerate_media for the given user (if the
+           kind is propics) or message, or None if the message media is unsupported"""
+        if kind == 'propics':
+            return {
+                'kind': kind,
+                'download': self.download_propic,
+                'media': tlobject.photo,
+                'output': self.media_handler.get_propic_path(tlobject),
+                'size': AVERAGE_PROPIC_SIZE,
+                'msg_id': None
+            }
+
+        if kind == 'photos':
+            return self.get_msg_media_item(tlobject, kind, self.download_photo,
+                                           tlobject.media.photo.sizes[-1].size)
+
+        return self.get_msg_media_item(tlobject, kind, self.download_document,
+                                       tlobject.media.document.size)
+
+    def get_msg_media_item(self, msg, kind, download, size):
+        """Returns the dictionary used by enumerate_media for the given message,
+           or None if the message media is unsupported"""
+        relative_path = self.media_handler.get_msg_media_relative_path(msg)
+        if relative_path:
+            return {
+                'kind': kind,
+                'download': download,
+                'media': msg.media,
+                'output': path.abspath(path.join(self.backup_dir, relative_path)),
+                'size': size,
+                'msg_id': msg.id,
+                'media_id': msg.media.photo.id if isinstance(msg.media, MessageMediaPhoto)
+                else msg.media.document.id,
+                'media_type': self.media_handler.get_msg_media_type(msg),
+                'path': relative_path
+            }
+
     def backup_media_thread(self, dl_propics, dl_photos, dl_docs,
                             docs_max_size=None, before_date=None, after_date=None,
-                            progress_callback=None):
-        """Backups the specified media contained in the given database file"""
+                            progress_callback=None, workers=None, planner=None):
+        """Backups the specified media contained in the given database file.
+
+           Every kind of media (propics, photos and docs) is downloaded concurrently
+           by its own pool of workers. How many workers each kind has can be given
+           as a {kind: count} dictionary, otherwise Backuper.media_workers is used.
+
+           If a MediaPlanner is given, all the kinds of media are instead downloaded
+           in the order it plans, by a single pool with all the workers together"""
         self.backup_running = True
+        workers = dict(Backuper.media_workers, **(workers if workers else {}))
+        self.media_handler.make_tree()
+
+        # Store how many bytes we have/how many bytes there are in total, and
+        # keep track of how fast we're downloading to determine the estimated time left.
+        # Since many workers update this, it must only be accessed with the lock
+        total = self.calculate_download_size(dl_propics, dl_photos, dl_docs, docs_max_size,
+                                             before_date=before_date, after_date=after_date)
+        progress = {
+            'current': 0,
+            'total': total,
+            'estimator': EtaEstimator(total_bytes=total),
+            # {item id: bytes} of the documents still being downloaded
+            'in_flight': {},
+            'last_report': 0
+        }
+        progress_lock = Lock()
 
-        # Create a connection to the database
-        db = TLDatabase(self.backup_dir)
+        filters = {
+            'docs_max_size': docs_max_size,
+            'before_date': before_date,
+            'after_date': after_date
+        }
+        kinds = [kind for kind, enabled in (('propics', dl_propics), ('photos', dl_photos),
+                                            ('docs', dl_docs)) if enabled]
+
+        threads = []
+        if planner:
+            # A single feeder follows the plan, so the order is kept across kinds
+            worker_count = sum(workers[kind] for kind in kinds)
+            queue = Queue(maxsize=worker_count * 2)
+            threads.append(Thread(target=self.media_planner_thread,
+                                  args=(queue, planner, kinds, worker_count),
+                                  kwargs=filters))
+            threads.extend(Thread(target=self.media_worker_thread,
+                                  args=(queue, progress, progress_lock, progress_callback))
+                           for _ in range(worker_count))
+        else:
+            for kind in kinds:
+                # Every kind has its own feeder, which enumerates the media to
+                # be downloaded, and its own workers, which download them
+                queue = Queue(maxsize=workers[kind] * 2)
+                threads.append(Thread(target=self.media_feeder_thread,
+                                      args=(queue, kind, workers[kind]),
+                                      kwargs=filters))
+                threads.extend(Thread(target=self.media_worker_thread,
+                                      args=(queue, progress, progress_lock, progress_callback))
+                               for _ in range(workers[kind]))
 
-        # Store how many bytes we have/how many bytes there are in total
-        current = 0
-        total = self.calculate_download_size(dl_propics, dl_photos, dl_docs,
-                                             docs_max_size, after_date, before_date)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.backup_running = False
 
-        # Keep track from when we started to determine the estimated time left
-        start = datetime.now()
+        # The last updates may have been coalesced, so always report how we ended
+        with progress_lock:
+            self.report_media_progress(progress, progress_callback, force=True)
 
-        if dl_propics:
-            # TODO Also query chats and channels
-            for user in db.query_users('where photo not null'):
+    def media_feeder_thread(self, queue, kind, worker_count, **filters):
+        """Feeds the given queue with the media of the given kind to be downloaded, in
+           the order it's enumerated (grouped by datacenter), and then tells all the
+           workers to stop by putting None as many times. The media is only loaded
+           as the workers make room for it in the queue"""
+        with TLDatabase(self.backup_dir) as db:
+            try:
+                for item in self.enumerate_media(db, kind, **filters):
+                    if not self.put_media_item(queue, item):
+                        return
+            finally:
+                for _ in range(worker_count):
+                    queue.put(None)
+
+    def media_planner_thread(self, queue, planner, kinds, worker_count, **filters):
+        """Feeds the given queue with the media of the given kinds to be downloaded,
+           in the order planned by the given MediaPlanner, and then tells all the
+           workers to stop by putting None as many times"""
+        with TLDatabase(self.backup_dir) as db:
+            try:
+                queries = {kind: self.get_media_filters(kind, **filters) for kind in kinds}
+                for kind, tlobject_id, _ in planner.plan(db, queries, AVERAGE_PROPIC_SIZE):
+                    if not self.backup_running:
+                        return
+
+                    # Only what's planned is loaded, one by one, as the workers need it
+                    if kind == 'propics':
+                        tlobject = db.query_user('where id = {}'.format(tlobject_id))
+                    else:
+                        tlobject = db.query_message('where id = {}'.format(tlobject_id))
+
+                    item = self.get_media_item(kind, tlobject)
+                    if item and not self.put_media_item(queue, item):
+                        return
+            finally:
+                for _ in range(worker_count):
+                    queue.put(None)
+
+    def put_media_item(self, queue, item):
+        """Puts the given item in the given queue, waiting while it's full, but only
+           as long as the backup is running. Returns whether the item was put"""
+        while self.backup_running:
+            try:
+                queue.put(item, timeout=Backuper.media_put_timeout)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def media_worker_thread(self, queue, progress, progress_lock, progress_callback):
+        """Downloads the media taken from the given queue until None is received.
+           The result of every message media download is saved to the media manifest.
+
+           Whatever goes wrong, the queue is always consumed until None is received,
+           or the feeder would block forever on a queue nobody drains"""
+        db = None
+        try:
+            db = TLDatabase(self.backup_dir)
+        except Exception as e:
+            print('Error opening the database:', e)
+            self.backup_running = False
+
+        # The connection this worker downloads through, only made once it's needed
+        connection = {}
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
                 if not self.backup_running:
-                    return
-                # Try downloading the photo
-                output = self.media_handler.get_propic_path(user)
-                try:
-                    if not self.valid_file_exists(output):
-                        self.client.download_profile_photo(
-                            user.photo, add_extension=False, file_path=output)
-                        sleep(self.download_delay)
+                    # Keep consuming so the feeder doesn't block
+                    continue
 
-                except RPCError as e:
-                    print('Error downloading profile photo:', e)
-                finally:
-                    current += AVERAGE_PROPIC_SIZE
-                    if progress_callback:
-                        progress_callback(current, total, self.calculate_etl(current, total, start))
+                self.download_media_item(db, connection, item,
+                                         progress, progress_lock, progress_callback)
+        finally:
+            if db:
+                db.close()
+            if connection:
+                self.disconnect_media_worker(connection['client'])
 
-        if dl_photos:
-            for msg in db.query_messages(self.get_query(MessageMediaPhoto, before_date, after_date)):
-                if not self.backup_running:
-                    return
-                # Try downloading the photo
-                output = self.media_handler.get_msg_media_path(msg)
-                try:
-                    if not self.valid_file_exists(output):
-                        self.client.download_msg_media(
-                            msg.media, add_extension=False, file_path=output)
-                        sleep(self.download_delay)
+    def connect_media_worker(self):
+        """Returns a new connection to the datacenter of the client, for a single media worker.
 
-                except RPCError as e:
-                    print('Error downloading photo:', e)
-                finally:
-                    current += msg.media.photo.sizes[-1].size
-                    if progress_callback:
-                        progress_callback(current, total, self.calculate_etl(current, total, start))
+           The connections can't be used by many threads at once, since their reads would
+           interleave, and invoking through the client itself would make every download
+           wait for the others. So every worker downloads through its own connection,
+           which also has its own connections to the other datacenters"""
+        return self.client.create_new_connection()
 
-        # TODO Add an internal callback to determine how the current document download is going,
-        # and update our currently saved bytes count based on that
-        if dl_docs:
-            for msg in db.query_messages(self.get_query(MessageMediaDocument, before_date, after_date)):
-                if not self.backup_running:
-                    return
+    @staticmethod
+    def disconnect_media_worker(client):
+        """Disconnects the given connection of a media worker,
+           and those it made to other datacenters"""
+        for exported_client in client._cached_clients.values():
+            exported_client.disconnect()
+        client.disconnect()
+
+    def download_media_item(self, db, connection, item, progress, progress_lock, progress_callback):
+        """Downloads the media of the given enumerate_media item, unless it's present already,
+           saving the result to the media manifest and reporting the progress made.
+           The given connection dictionary holds the 'client' the worker downloads through.
+           If the download fails, the error is printed and the media marked as failed"""
+        kind, media, output, size = item['kind'], item['media'], item['output'], item['size']
+
+        # Documents can be big, so ensure they're complete and not just present
+        exact_size = size if kind == 'docs' else None
+
+        # Documents report their progress while they're being downloaded
+        kwargs = {}
+        if kind == 'docs':
+            kwargs['progress_callback'] = lambda downloaded, _, item_id=id(item): \
+                self.on_media_download_progress(item_id, downloaded, progress,
+                                                progress_lock, progress_callback)
+
+        key = None
+        failed = False
+        # How many bytes were downloaded (not taken from disk or from the store)
+        downloaded_size = 0
+        try:
+            key = self.media_store.get_key(media)
+            if not self.valid_file_exists(output, size=exact_size):
+                # Other backups may have downloaded this very same media already
+                if key and self.media_store.is_valid(key):
+                    self.media_store.materialize(key, output)
+
+                # Documents draw their bandwidth part by part while downloading,
+                # but we can't do that for the rest, so draw their whole size first
+                elif kind == 'docs' or self.bandwidth_governor.acquire(
+                        size, running=self.is_backup_running):
+                    if not connection:
+                        connection['client'] = self.connect_media_worker()
+
+                    self.rate_governor.invoke(item['download'], connection['client'], media, output,
+                                              running=self.is_backup_running, **kwargs)
+                    if kind != 'docs' and self.valid_file_exists(output):
+                        downloaded_size = size
+
+                    # Only complete files may be shared. The size of the profile
+                    # photos is unknown, so these can't be told to be complete
+                    if key and kind != 'propics' and self.valid_file_exists(output, size=size):
+                        self.media_store.add(key, output)
+
+        except Exception as e:
+            # Not only RPC errors, but also lost connections and the like, may
+            # happen here. These only make this media fail, not the whole worker
+            print('Error downloading {}:'.format(kind), e)
+            failed = True
 
-                if not docs_max_size or msg.media.document.size <= docs_max_size:
-                    # Try downloading the document
-                    output = self.media_handler.get_msg_media_path(msg)
+        finally:
+            try:
+                if item['msg_id'] and db:
+                    self.save_media_manifest(db, item, key, exact_size, failed=failed)
+            except Exception as e:
+                print('Error saving the media manifest:', e)
+
+            with progress_lock:
+                # The bytes already reported while downloading were counted already
+                reported = progress['in_flight'].pop(id(item), 0)
+                progress['current'] += size - reported
+
+                # Only what was downloaded tells how fast we're going. The rest (the media
+                # which was present, taken from the store or failed) took no time
+                downloaded_size = max(downloaded_size, reported)
+                if downloaded_size:
+                    progress['estimator'].update(items=1, size=downloaded_size - reported)
+                    progress['estimator'].skip(items=0, size=size - downloaded_size)
+                else:
+                    progress['estimator'].skip(items=1, size=size)
+
+                self.report_media_progress(progress, progress_callback)
+
+    def on_media_download_progress(self, item_id, downloaded, progress,
+                                   progress_lock, progress_callback):
+        """Called while the media with the given item ID is being downloaded,
+           with how many of its bytes have been downloaded so far"""
+        with progress_lock:
+            reported = progress['in_flight'].get(item_id, 0)
+            if downloaded <= reported:
+                return
+
+            progress['in_flight'][item_id] = downloaded
+            progress['current'] += downloaded - reported
+            progress['estimator'].update(items=0, size=downloaded - reported)
+            self.report_media_progress(progress, progress_callback)
+
+    def report_media_progress(self, progress, progress_callback, force=False):
+        """Invokes the progress callback with the given progress, unless it was already
+           invoked less than 1/Backuper.media_progress_rate seconds ago (and not forced).
+           The progress lock must be held while calling this method"""
+        if not progress_callback:
+            return
+
+        now = monotonic()
+        if not force and now - progress['last_report'] < 1 / Backuper.media_progress_rate:
+            return
+
+        progress['last_report'] = now
+        etl = progress['estimator'].get_etl()
+        progress_callback(min(progress['current'], progress['total']), progress['total'],
+                          etl if etl is not None else timedelta(seconds=0))
+
+    def save_media_manifest(self, db, item, key, exact_size, failed=False):
+        """Saves the result of downloading the given enumerate_media item to the media manifest.
+           If the download failed, the media is marked as such even if the backup was stopped"""
+        output = item['output']
+        if self.valid_file_exists(output, size=exact_size):
+            status = 'downloaded'
+        elif failed or self.backup_running:
+            status = 'failed'
+        else:
+            status = 'pending'
+
+        db.set_media(msg_id=item['msg_id'],
+                     media_id=item['media_id'],
+                     kind=item['media_type'],
+                     relative_path=item['path'],
+                     expected_size=item['size'],
+                     downloaded_size=path.getsize(output) if path.isfile(output) else 0,
+                     checksum=self.media_store.read_checksum(key)[0] if key else None,
+                     status=status)
+        db.commit()
+
+    def download_propic(self, client, photo, file_path):
+        """Downloads the given profile photo (its big version) to the given
+           file path, through the given client (a connection of the worker)"""
+        self.download_location(client, photo.photo_big, file_path)
+
+    def download_photo(self, client, media, file_path):
+        """Downloads the photo of the given message media (its biggest size) to
+           the given file path, through the given client (a connection of the worker)"""
+        size = media.photo.sizes[-1]
+        self.download_location(client, size.location, file_path, size=size.size)
+
+    @staticmethod
+    def download_location(client, location, file_path, size=None):
+        """Downloads the file at the given FileLocation to the given file path, through
+           the given client. The file is downloaded to a .part file first, which is only
+           renamed to the given file path once it's complete"""
+        part_file = file_path + '.part'
+        client.download_file(InputFileLocation(volume_id=location.volume_id,
+                                               local_id=location.local_id,
+                                               secret=location.secret),
+                             part_file, file_size=size)
+        replace(part_file, file_path)
+
+    def download_document(self, client, media, file_path, progress_callback=None):
+        """Downloads the document of the given message media to the given file path,
+           through the given client (a connection of the worker).
+
+           The document is downloaded to a .part file first, and how many bytes were
+           written is saved after every part, so that if the download is interrupted,
+           it is resumed from that offset the next time. Once the whole document has
+           been downloaded, the .part file is renamed to the given file path.
+
+           Documents served by a CDN are decrypted (and checked) as they arrive. Their
+           checks can only be made from the start, so these are never resumed.
+
+           Every part draws its bytes from the bandwidth governor before being requested.
+           If a progress_callback is given, progress_callback(downloaded bytes, total bytes)
+           is invoked after every part, only counting the bytes downloaded by this call"""
+        document = media.document
+        part_file = file_path + '.part'
+        offset_file = part_file + '.offset'
+
+        # Resume from the last saved offset, as long as the .part file has
+        # those bytes, aligned to the part size as Telegram requires
+        offset = 0
+        if path.isfile(part_file) and path.isfile(offset_file):
+            with open(offset_file, 'r', encoding='utf-8') as file:
+                offset = min(int(file.read() or 0), path.getsize(part_file))
+            offset -= offset % Backuper.download_part_size
+
+        location = InputDocumentFileLocation(id=document.id,
+                                             access_hash=document.access_hash,
+                                             version=document.version)
+        start_offset = offset
+        cdn_decrypter = None
+        try:
+            with open(part_file, 'r+b' if offset else 'wb') as file:
+                file.seek(offset)
+                file.truncate()
+                while offset < document.size and self.backup_running:
+                    if not self.bandwidth_governor.acquire(Backuper.download_part_size,
+                                                           running=self.is_backup_running):
+                        break
                     try:
-                        if not self.valid_file_exists(output):
-                            self.client.download_msg_media(
-                                msg.media, add_extension=False, file_path=output)
-                        sleep(self.download_delay)
-
-                    except RPCError as e:
-                        print('Error downloading document:', e)
-                    finally:
-                        current += msg.media.document.size
-                        if progress_callback:
-                            progress_callback(current, total, self.calculate_etl(current, total, start))
-        db.close()
+                        if cdn_decrypter:
+                            result = cdn_decrypter.get_file(offset, Backuper.download_part_size)
+                        else:
+                            result = client.invoke(GetFileRequest(location, offset,
+                                                                  Backuper.download_part_size))
+                            if isinstance(result, FileCdnRedirect):
+                                if offset:
+                                    # The CDN can't be resumed, so start over
+                                    offset = start_offset = 0
+                                    file.seek(0)
+                                    file.truncate()
+                                    continue
+
+                                cdn_decrypter, result = CdnDecrypter.prepare_decrypter(
+                                    client, TelegramBareClient, result, offset, Backuper.download_part_size)
+
+                    except FileMigrateError as e:
+                        # The document lives in another datacenter
+                        client = client._get_exported_client(e.new_dc)
+                        continue
+
+                    if not result.bytes:
+                        break
+
+                    file.write(result.bytes)
+                    file.flush()
+                    offset += len(result.bytes)
+                    with open(offset_file, 'w', encoding='utf-8') as offset_handle:
+                        offset_handle.write(str(offset))
+
+                    if progress_callback:
+                        progress_callback(offset - start_offset, document.size - start_offset)
+
+            if offset >= document.size:
+                if cdn_decrypter:
+                    cdn_decrypter.finish_check()
+
+                replace(part_file, file_path)
+                # Empty documents never had any offset saved
+                if path.isfile(offset_file):
+                    remove(offset_file)
+        finally:
+            if cdn_decrypter:
+                cdn_decrypter.client.disconnect()
 
     #endregion
 
@@ -427,37 +1312,42 @@ class Backuper:
 
     #region Utilities
 
-    def calculate_etl(self, downloaded, total, start=None):
-        """Calculates the estimated time left, based on how long it took us
-           to reach "downloaded" and how many messages we have left.
+    def calculate_etl(self, downloaded, total, estimator=None):
+        """Calculates the estimated time left for the messages left to be downloaded.
+
+           If an EtaEstimator is given and it already knows how fast we're going, its
+           estimation is used. Otherwise, the time will simply be estimated by how many
+           chunks are left, which will NOT work if what is being downloaded is media"""
+        if estimator:
+            etl = estimator.get_etl()
+            if etl is not None:
+                return etl
 
-           If no start time is given, the time will simply by estimated by how
-           many chunks are left, which will NOT work if what is being downloaded is media"""
         left = total - downloaded
-        if not start:
-            # We add chunk size - 1 because division will truncate the decimal places,
-            # so for example, if we had a chunk size of 8:
-            #   7 messages + 7 = 14 -> 14 // 8 = 1 chunk download required
-            #   8 messages + 7 = 15 -> 15 // 8 = 1 chunk download required
-            #   9 messages + 7 = 16 -> 16 // 8 = 2 chunks download required
-            #
-            # Clearly, both 7 and 8 fit in one chunk, but 9 doesn't.
-            chunks_left = (left + self.download_chunk_size - 1) // self.download_chunk_size
-            etl = chunks_left * self.download_delay
-        else:
-            if downloaded:
-                delta_time = (datetime.now() - start).total_seconds() / downloaded
-                etl = left * delta_time
-            else:
-                etl = 0
+
+        # We add chunk size - 1 because division will truncate the decimal places,
+        # so for example, if we had a chunk size of 8:
+        #   7 messages + 7 = 14 -> 14 // 8 = 1 chunk download required
+        #   8 messages + 7 = 15 -> 15 // 8 = 1 chunk download required
+        #   9 messages + 7 = 16 -> 16 // 8 = 2 chunks download required
+        #
+        # Clearly, both 7 and 8 fit in one chunk, but 9 doesn't.
+        chunks_left = (left + self.download_chunk_size - 1) // self.download_chunk_size
+        etl = chunks_left * self.rate_governor.get_delay()
 
         return timedelta(seconds=round(etl, 1))
 
     @staticmethod
-    def get_query(clazz, before_date=None, after_date=None):
+    def get_query(clazz, before_date=None, after_date=None, max_size=None, skip_downloaded=False):
         """Returns a database query filtering by media_id (its class),
-           and optionally range dates"""
+           and optionally range dates and the maximum media size in bytes.
+           If skip_downloaded is given, the messages whose media was
+           already downloaded are filtered out"""
         filters = 'where media_id = {}'.format(clazz.constructor_id)
+        if max_size:
+            filters += ' and media_size <= {}'.format(int(max_size))
+        if skip_downloaded:
+            filters += " and id not in (select msg_id from media where status = 'downloaded')"
         if before_date:
             filters += " and date <= '{}'".format(before_date)
         if after_date:
@@ -465,9 +1355,14 @@ class Backuper:
         return filters
 
     @staticmethod
-    def valid_file_exists(file):
+    def valid_file_exists(file, size=None):
         """Determines whether a file exists and its "valid"
-           (i.e., the file size is greater than 0; if it's 0, it probably faild dueto an RPC error)"""
-        return path.isfile(file) and path.getsize(file) > 0
+           (i.e., the file size is greater than 0; if it's 0, it probably faild dueto an RPC error).
+           If the expected size is given, the file size must also match it"""
+        if not path.isfile(file):
+            return False
+
+        file_size = path.getsize(file)
+        return file_size == size if size is not None else file_size > 0
 
     #endregion
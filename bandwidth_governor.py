@@ -0,0 +1,100 @@
+from datetime import datetime
+from threading import Condition
+from time import monotonic
+
+
+class BandwidthGovernor:
+    """Token bucket, measured in bytes, from which all the media downloads
+       draw the bytes they download. It can (and should) be shared by every
+       worker and every Backuper, so the total bytes per second across all
+       of them stay under the cap.
+
+       The cap can change depending on the time of the day, by giving a
+       schedule of (start, end, rate) tuples, where start and end are
+       datetime.time objects (the period wraps around midnight if the end
+       comes before the start). A rate of None means no cap at all,
+       and a rate of 0 pauses the downloads during that period"""
+
+    #region Initialization
+
+    def __init__(self, rate=None, schedule=None, burst=1):
+        """
+        :param rate:     The cap, in bytes per second, used outside the scheduled periods.
+                         If None, the downloads are not capped outside of them
+        :param schedule: A list of (start, end, rate) tuples overriding the cap during those periods
+        :param burst:    How many seconds worth of bytes can be downloaded at once after being idle
+        """
+        self.rate = rate
+        self.schedule = schedule if schedule else []
+        self.burst = burst
+
+        self.tokens = 0
+        self.last_refill = monotonic()
+
+        # Some statistics
+        self.downloaded_bytes = 0
+
+        self.condition = Condition()
+
+    #endregion
+
+    #region Scheduling
+
+    def get_rate(self, now=None):
+        """Returns the cap (in bytes per second, or None if there is none)
+           at the given datetime, or now if none is given"""
+        current = (now if now else datetime.now()).time()
+        for start, end, rate in self.schedule:
+            if start <= end:
+                if start <= current < end:
+                    return rate
+            elif current >= start or current < end:
+                return rate
+
+        return self.rate
+
+    #endregion
+
+    #region Acquiring
+
+    # How long we sleep at most before checking again whether we should still wait,
+    # which is also how long it takes at most to notice a change in the schedule
+    max_sleep = 1
+
+    def acquire(self, size, running=None):
+        """Blocks until the given amount of bytes can be downloaded. If a `running`
+           function is given and it returns False while waiting, False is returned.
+
+           The bytes are drawn even if there aren't as many in the bucket (so the
+           bucket can go into debt) to allow parts bigger than the cap itself,
+           in which case the following downloads will have to wait longer"""
+        with self.condition:
+            while True:
+                rate = self.get_rate()
+                now = monotonic()
+                if rate is None:
+                    # Not capped, so there is no need to keep the bucket either
+                    self.tokens = 0
+                    self.last_refill = now
+                    break
+
+                self.refill(now, rate)
+                if self.tokens >= 0 and rate > 0:
+                    break
+
+                if running and not running():
+                    return False
+
+                wait = -self.tokens / rate if rate > 0 else BandwidthGovernor.max_sleep
+                self.condition.wait(min(wait, BandwidthGovernor.max_sleep))
+
+            self.tokens -= size
+            self.downloaded_bytes += size
+            return True
+
+    def refill(self, now, rate):
+        """Refills the bucket with the bytes gained at the given rate since the last refill"""
+        self.tokens = min(rate * self.burst, self.tokens + (now - self.last_refill) * rate)
+        self.last_refill = now
+
+    #endregion
@@ -0,0 +1,95 @@
+"""Ingests a synthetic history message by message (as Backuper used to, with one
+   in_table probe and one insert per message) and in batches (as it does now, with
+   which_in_table and add_objects), and prints how many rows per second each saved.
+   Both skip rewriting the users which didn't change, so only the batching differs.
+   The chunks are made before timing, so only the time spent saving them is measured.
+
+   Then it prints where the time goes: how long building the rows takes (converting
+   the objects, including the content hash of the messages), how long hashing takes
+   on its own, and how long fingerprinting the users takes. Whatever is left of each
+   run is spent by SQLite.
+
+   Usage: python -m benchmarks.batched_ingestion [messages] [runs]"""
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.synthetic import make_chunks
+from tl_database import TLDatabase
+
+
+def ingest_per_row(db, chunks):
+    """Saves the chunks the way they used to be saved, row by row"""
+    for users, msgs in chunks:
+        for user in users:
+            db.add_object(user, replace=True)
+
+        for msg in msgs:
+            if db.in_table(msg.id, 'messages'):
+                break
+            db.add_object(msg)
+
+        db.commit()
+
+
+def ingest_batched(db, chunks):
+    """Saves the chunks the way Backuper saves them, with a single query per table"""
+    for users, msgs in chunks:
+        db.add_objects(users, replace=True)
+        saved_ids = db.which_in_table((msg.id for msg in msgs), 'messages')
+        db.add_objects(msg for msg in msgs if msg.id not in saved_ids)
+        db.commit()
+
+
+def measure(ingest, chunks):
+    """Returns how many seconds the given ingest function took to save the chunks"""
+    with TemporaryDirectory() as directory:
+        with TLDatabase(directory) as db:
+            start = perf_counter()
+            ingest(db, chunks)
+            return perf_counter() - start
+
+
+def measure_rows(chunks):
+    """Returns how many seconds it takes to build the rows of the chunks, how many
+       of them are spent on the content hashes of the messages, and how many seconds
+       it takes to fingerprint the users to tell whether they changed"""
+    start = perf_counter()
+    rows = [TLDatabase.get_table_and_row(tlobject)
+            for users, msgs in chunks for tlobject in users + msgs]
+    building = perf_counter() - start
+
+    # The content hash of a message is calculated over its first 14 columns
+    msg_rows = [row[:14] for tablename, row in rows if tablename == 'messages']
+    start = perf_counter()
+    for row in msg_rows:
+        TLDatabase.get_content_hash(row)
+    hashing = perf_counter() - start
+
+    user_rows = [row for tablename, row in rows if tablename == 'users']
+    start = perf_counter()
+    for row in user_rows:
+        TLDatabase.get_content_hash(row)
+    return building, hashing, perf_counter() - start
+
+
+def main():
+    total_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    chunks = list(make_chunks(total_msgs))
+    rows = sum(len(users) + len(msgs) for users, msgs in chunks)
+
+    # The fastest of every run is the least disturbed by everything else
+    building, hashing, fingerprinting = min(measure_rows(chunks) for _ in range(runs))
+    print('Building {:,} rows: {:.2f} s, of which {:.2f} s are content hashes'
+          .format(rows, building, hashing))
+    print('Fingerprinting the users: {:.2f} s'.format(fingerprinting))
+
+    for name, ingest in (('per row', ingest_per_row), ('batched', ingest_batched)):
+        elapsed = min(measure(ingest, chunks) for _ in range(runs))
+        print('{:>10}: {:,.0f} rows/sec, {:.2f} s ({:.2f} s in SQLite)'
+              .format(name, rows / elapsed, elapsed, elapsed - building - fingerprinting))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Counts how many times a fake client has to switch between datacenters when
+   downloading the media of a synthetic backup in table order (as it used to be
+   downloaded) and in the order Backuper.media_feeder_thread feeds it.
+
+   Usage: python -m benchmarks.dc_switches [media count] [datacenter count]"""
+import sys
+from datetime import datetime
+from queue import Queue
+from random import Random
+from tempfile import TemporaryDirectory
+
+from telethon.tl.types import Document, DocumentAttributeFilename, Message, MessageMediaDocument, \
+    PeerUser, PhotoSizeEmpty, User
+
+from backuper import Backuper
+from media_handler import MediaHandler
+from tl_database import TLDatabase
+
+
+class FakeClient:
+    """Client which only remembers how many times it switched datacenters"""
+    def __init__(self):
+        self.dc_id = None
+        self.switches = 0
+
+    def download_media(self, media):
+        dc_id = MediaHandler.get_media_dc_id(media)
+        if dc_id != self.dc_id:
+            if self.dc_id is not None:
+                self.switches += 1
+            self.dc_id = dc_id
+
+
+def make_messages(count, dc_count, seed=0):
+    """Makes the given amount of messages with documents, stored in random datacenters"""
+    random = Random(seed)
+    return [Message(id=msg_id, to_id=PeerUser(1), date=datetime(2017, 1, 1), message='',
+                    media=MessageMediaDocument(caption='', document=Document(
+                        id=msg_id, access_hash=0, date=datetime(2017, 1, 1), mime_type='video/mp4',
+                        size=1024, thumb=PhotoSizeEmpty(''), dc_id=random.randint(1, dc_count),
+                        version=0, attributes=[DocumentAttributeFilename('{}.mp4'.format(msg_id))])))
+            for msg_id in range(1, count + 1)]
+
+
+def get_fed_media(backuper):
+    """Returns the media in the order Backuper.media_feeder_thread feeds it"""
+    backuper.backup_running = True
+    queue = Queue()
+    backuper.media_feeder_thread(queue, 'docs', worker_count=1)
+    return [item['media'] for item in iter(queue.get, None)]
+
+
+def count_switches(media):
+    """Returns how many datacenter switches a client makes to download the given media"""
+    client = FakeClient()
+    for single_media in media:
+        client.download_media(single_media)
+    return client.switches
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    dc_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with TemporaryDirectory() as directory:
+        Backuper.backups_dir = directory
+        backuper = Backuper(FakeClient(), User(id=1))
+        with TLDatabase(backuper.backup_dir) as db:
+            db.add_objects(make_messages(count, dc_count))
+            db.commit()
+            table_media = [msg.media for msg in db.query_messages('order by id')]
+
+        print('Table order: {} datacenter switches'.format(count_switches(table_media)))
+        print('Fed by datacenter: {} datacenter switches'.format(count_switches(get_fed_media(backuper))))
+
+
+if __name__ == '__main__':
+    main()
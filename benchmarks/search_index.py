@@ -0,0 +1,70 @@
+"""Measures what the full-text search index costs: ingests a synthetic history, the same
+   way Backuper.backup_messages_writer_thread does (one commit per chunk, with the
+   metadata), into a database with the index and into one without it (as databases were
+   before it existed), and prints how many messages per second each saved and how big
+   each database ended up. Then it times indexing the latter, as its migration would.
+
+   Usage: python -m benchmarks.search_index [messages]"""
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.synthetic import make_chunks
+from tl_database import TLDatabase
+
+
+def drop_search_index(db):
+    """Drops the full-text search index (and its triggers) from the given database"""
+    for trigger in ('insert', 'delete', 'update'):
+        db.con.execute('drop trigger messages_search_{}'.format(trigger))
+    db.con.execute('drop table messages_search')
+    db.commit()
+
+
+def ingest(db, total_msgs):
+    """Ingests the synthetic history in the given database, returning the messages per second"""
+    start = perf_counter()
+    saved_msgs = 0
+    for users, msgs in make_chunks(total_msgs):
+        db.add_objects(users, replace=True)
+        saved_ids = db.which_in_table((msg.id for msg in msgs), 'messages')
+        new_msgs = [msg for msg in msgs if msg.id not in saved_ids]
+        db.add_objects(new_msgs)
+        saved_msgs += len(new_msgs)
+        db.set_metadata({'resume_msg_id': msgs[-1].id, 'saved_msgs': saved_msgs})
+        db.commit()
+
+    return saved_msgs / (perf_counter() - start)
+
+
+def get_size(db):
+    """Returns the size of the given database, after checkpointing its write-ahead log"""
+    db.con.execute('pragma wal_checkpoint(truncate)')
+    return db.con.execute('pragma page_count').fetchone()[0] * \
+        db.con.execute('pragma page_size').fetchone()[0]
+
+
+def main():
+    total_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with TemporaryDirectory() as plain, TemporaryDirectory() as indexed:
+        with TLDatabase(plain) as db:
+            drop_search_index(db)
+            plain_rate = ingest(db, total_msgs)
+            plain_size = get_size(db)
+
+            start = perf_counter()
+            db.migrate_message_search()
+            db.commit()
+            migration_time = perf_counter() - start
+
+        with TLDatabase(indexed) as db:
+            indexed_rate = ingest(db, total_msgs)
+            indexed_size = get_size(db)
+
+    print('Without the index: {:,.0f} messages/sec, {:,} bytes'.format(plain_rate, plain_size))
+    print('   With the index: {:,.0f} messages/sec, {:,} bytes ({:+.1%} time per message)'.format(
+        indexed_rate, indexed_size, plain_rate / indexed_rate - 1))
+    print('Indexing {:,} saved messages: {:.2f} seconds'.format(total_msgs, migration_time))
+
+if __name__ == '__main__':
+    main()
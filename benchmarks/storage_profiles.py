@@ -0,0 +1,48 @@
+"""Ingests a synthetic history under every TLDatabase storage profile, the same way
+   Backuper.backup_messages_writer_thread does (one commit per chunk, with the
+   metadata), and prints how many messages per second each profile saved.
+   The 'journal' profile is how databases were opened before storage profiles existed.
+
+   Usage: python -m benchmarks.storage_profiles [messages] [profile...]"""
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.synthetic import make_chunks
+from tl_database import TLDatabase
+
+# SQLite's own defaults, used before the storage profiles existed
+BASELINE_PROFILES = {
+    'journal': {'journal_mode': 'delete', 'synchronous': 'full'}
+}
+
+
+def ingest(directory, total_msgs, storage_profile):
+    """Ingests the synthetic history in the given directory, returning the messages per second"""
+    storage_profile = BASELINE_PROFILES.get(storage_profile, storage_profile)
+    with TLDatabase(directory, storage_profile=storage_profile) as db:
+        start = perf_counter()
+        saved_msgs = 0
+        for users, msgs in make_chunks(total_msgs):
+            db.add_objects(users, replace=True)
+            saved_ids = db.which_in_table((msg.id for msg in msgs), 'messages')
+            new_msgs = [msg for msg in msgs if msg.id not in saved_ids]
+            db.add_objects(new_msgs)
+            saved_msgs += len(new_msgs)
+            db.set_metadata({'resume_msg_id': msgs[-1].id, 'saved_msgs': saved_msgs})
+            db.commit()
+
+        return saved_msgs / (perf_counter() - start)
+
+
+def main():
+    total_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    profiles = sys.argv[2:] if len(sys.argv) > 2 else \
+        list(BASELINE_PROFILES) + list(TLDatabase.storage_profiles)
+    for profile in profiles:
+        with TemporaryDirectory() as directory:
+            print('{:>10}: {:,.0f} messages/sec'.format(profile, ingest(directory, total_msgs, profile)))
+
+
+if __name__ == '__main__':
+    main()
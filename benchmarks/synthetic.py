@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+from random import Random
+
+from telethon.tl.types import Message, PeerUser, User
+
+WORDS = ('hello', 'backup', 'telegram', 'photo', 'channel', 'message', 'tomorrow',
+         'meeting', 'document', 'sticker', 'video', 'link', 'thanks', 'yes', 'no')
+
+
+def make_users(count):
+    """Makes the given amount of synthetic users"""
+    return [User(id=user_id, first_name='User {}'.format(user_id)) for user_id in range(1, count + 1)]
+
+
+def make_chunks(total_msgs, chunk_size=100, user_count=50, seed=0):
+    """Yields (users, messages) chunks of a synthetic history with the given amount of
+       messages, from the newest to the oldest, like GetHistoryRequest returns them"""
+    random = Random(seed)
+    users = make_users(user_count)
+    first_date = datetime(2015, 1, 1)
+    for top_id in range(total_msgs, 0, -chunk_size):
+        msgs = []
+        for msg_id in range(top_id, max(top_id - chunk_size, 0), -1):
+            sender = random.choice(users)
+            msgs.append(Message(id=msg_id,
+                                to_id=PeerUser(1),
+                                from_id=sender.id,
+                                date=first_date + timedelta(minutes=msg_id),
+                                message=' '.join(random.choice(WORDS)
+                                                 for _ in range(random.randint(1, 20)))))
+
+        yield random.sample(users, min(10, len(users))), msgs
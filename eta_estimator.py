@@ -0,0 +1,103 @@
+from datetime import timedelta
+from math import exp
+from threading import Lock
+from time import monotonic
+
+
+class EtaEstimator:
+    """Estimates the time left for a job based on its recent throughput.
+
+       Both the items per second and the bytes per second are tracked as
+       exponentially weighted averages, so the estimation follows rate changes
+       instead of averaging the whole run. Whenever there is a total amount of
+       bytes, these are used, since items (such as media files) may vary in
+       size by orders of magnitude. It's safe to feed it from many threads"""
+
+    #region Initialization
+
+    def __init__(self, total_items=0, total_bytes=0, done_items=0, done_bytes=0,
+                 time_constant=30, min_interval=1):
+        """
+        :param total_items:   How many items there are in total
+        :param total_bytes:   How many bytes there are in total (0 if unknown)
+        :param done_items:    How many items were already done before we started
+        :param done_bytes:    How many bytes were already done before we started
+        :param time_constant: How many seconds it takes for older rates to lose most of their weight
+        :param min_interval:  The rates are only updated after at least these many seconds,
+                              so that bursts of tiny items don't make the rate skyrocket
+        """
+        self.total_items = total_items
+        self.total_bytes = total_bytes
+        self.done_items = done_items
+        self.done_bytes = done_bytes
+
+        self.time_constant = time_constant
+        self.min_interval = min_interval
+
+        # None until we have the first measure
+        self.items_rate = None
+        self.bytes_rate = None
+
+        # What's been done since the rates were last updated
+        self.pending_items = 0
+        self.pending_bytes = 0
+        self.last_update = monotonic()
+
+        self.lock = Lock()
+
+    #endregion
+
+    #region Updating
+
+    def update(self, items=1, size=0):
+        """Notifies that the given items (of the given total size in bytes) were done"""
+        with self.lock:
+            self.done_items += items
+            self.done_bytes += size
+            self.pending_items += items
+            self.pending_bytes += size
+
+            now = monotonic()
+            elapsed = now - self.last_update
+            if elapsed < self.min_interval:
+                return
+
+            # The longer it's been since the last update, the more weight the new rate has
+            weight = 1 - exp(-elapsed / self.time_constant)
+            self.items_rate = self.average(self.items_rate, self.pending_items / elapsed, weight)
+            self.bytes_rate = self.average(self.bytes_rate, self.pending_bytes / elapsed, weight)
+
+            self.pending_items = 0
+            self.pending_bytes = 0
+            self.last_update = now
+
+    def skip(self, items=1, size=0):
+        """Notifies that the given items (of the given total size in bytes) were done
+           without taking any time (for example, because they were done already), so
+           they count towards what's left, but not towards how fast we're going"""
+        with self.lock:
+            self.done_items += items
+            self.done_bytes += size
+
+    @staticmethod
+    def average(previous, current, weight):
+        """Averages the previous (or None) and current rates with the given weight"""
+        return current if previous is None else previous + weight * (current - previous)
+
+    #endregion
+
+    #region Estimating
+
+    def get_etl(self):
+        """Returns the estimated time left as a timedelta, or None if it's unknown yet"""
+        with self.lock:
+            if self.total_bytes and self.bytes_rate:
+                left = max(self.total_bytes - self.done_bytes, 0) / self.bytes_rate
+            elif self.items_rate:
+                left = max(self.total_items - self.done_items, 0) / self.items_rate
+            else:
+                return None
+
+            return timedelta(seconds=round(left, 1))
+
+    #endregion
@@ -1,4 +1,4 @@
-from datetime import date, timedelta, datetime
+from datetime import date, timedelta
 from os import path, makedirs
 from shutil import copyfile
 from threading import Thread
@@ -7,6 +7,7 @@ from os.path import isfile
 
 from telethon.tl.types import MessageService
 
+from eta_estimator import EtaEstimator
 from exporter import HTMLTLWriter
 from media_handler import MediaHandler
 from tl_database import TLDatabase
@@ -63,7 +64,7 @@ class Exporter:
 
             # The first date will obviously be the first day
             # TODO This fails if there are 0 messages in the database, export should be disabled!
-            previous_date = self.get_message_date(db.query_message('order by id asc'))
+            previous_date = self.get_message_date(db.select_one('messages', ('date',), order_by=['id']))
 
             # Also find the next day
             following_date = self.get_previous_and_next_day(db, previous_date)[1]
@@ -72,8 +73,12 @@ class Exporter:
             writer = HTMLTLWriter(previous_date, self.media_handler,
                                   following_date=following_date)
 
-            # Keep track from when we started to determine the estimated time left
-            start = datetime.now()
+            # Keep track of how fast we're exporting to determine the estimated time left
+            estimator = EtaEstimator(total_items=progress['total'])
+
+            # The media manifest tells which media was downloaded and where, so there's
+            # no need to probe the files. Older media may not be on the manifest, though
+            downloaded_media = db.get_downloaded_media()
 
             # Export the profile photos, from users chats and channels
             # TODO This should also have a progress if we have a backup of thousands of files!
@@ -88,6 +93,7 @@ class Exporter:
             for msg in db.query_messages('order by id asc'):
                 msg_date = self.get_message_date(msg)
                 progress['exported'] += 1
+                estimator.update(items=1)
 
                 # As soon as we're in the next day, update the output the writer
                 if msg_date != previous_date:
@@ -103,7 +109,8 @@ class Exporter:
                                           following_date=following_date)
                     # Call the callback
                     if callback:
-                        progress['etl'] = self.calculate_etl(start, progress['exported'], progress['total'])
+                        etl = estimator.get_etl()
+                        progress['etl'] = etl if etl is not None else 'Unknown'
                         callback(progress)
                     else:
                         print(progress)
@@ -111,11 +118,18 @@ class Exporter:
                 writer.write_message(msg, db)
                 # If the message has media, we need to copy it so it's accessible by the exported HTML
                 if not isinstance(msg, MessageService) and msg.media:
-                    source = db_media_handler.get_msg_media_path(msg)
-                    output = self.media_handler.get_msg_media_path(msg)
-                    # Source may be None if the media is unsupported (i.e. a webpage)
-                    if source and isfile(source):
-                        copyfile(source, output)
+                    # Media downloaded before the manifest existed may have no entry on it
+                    # yet, and the files listed on it may have been deleted since then
+                    relative_path = downloaded_media.get(msg.id)
+                    if relative_path and isfile(path.join(self.backups_dir, relative_path)):
+                        copyfile(path.join(self.backups_dir, relative_path),
+                                 path.join(self.output_dir, relative_path))
+                    else:
+                        source = db_media_handler.get_msg_media_path(msg)
+                        output = self.media_handler.get_msg_media_path(msg)
+                        # Source may be None if the media is unsupported (i.e. a webpage)
+                        if source and isfile(source):
+                            copyfile(source, output)
 
                 previous_date = msg_date
 
@@ -133,24 +147,19 @@ class Exporter:
     @staticmethod
     def get_previous_and_next_day(db, message_date):
         """Gets the previous and following saved days given the day in between in the database"""
-        previous = db.query_message("where date < '{}' order by id desc"
-                                    .format(message_date))
-        following = db.query_message("where date >= '{}' order by id asc"
-                                     .format(message_date+timedelta(days=1)))
+        # Only the dates are needed, and ordering by them (rather than
+        # by ID) lets the date index be used alone
+        previous = db.select_one('messages', ('date',),
+                                 [('date', '<', message_date)], order_by=[('date', 'desc')])
+        following = db.select_one('messages', ('date',),
+                                  [('date', '>=', message_date + timedelta(days=1))],
+                                  order_by=[('date', 'asc')])
 
         return Exporter.get_message_date(previous), Exporter.get_message_date(following)
 
-    @staticmethod
-    def calculate_etl(start, saved, total):
-        """Calculates the estimated time left, based on how long it took us
-           to reach "saved" and how many messages we have left"""
-        delta_time = (datetime.now() - start).total_seconds() / saved
-        left = total - saved
-        return timedelta(seconds=round(left * delta_time, 1))
-
     @staticmethod
     def get_message_date(message):
-        """Retrieves the given message DATE, ignoring the time (hour, minutes, seconds, etc.)"""
+        """Retrieves the given message (or row with a date) DATE, ignoring the time (hour, minutes, seconds, etc.)"""
         if message:
             return date(year=message.date.year, month=message.date.month, day=message.date.day)
 
@@ -256,7 +256,7 @@ class HTMLFormatter:
                 entities.append((e.offset, '<a href="mailto:{}" target="_blank">'.format(mail)))
                 entities.append((e.offset + e.length, '</a>'))
 
-            # TODO No support for searching for messages yet
+            # TODO The backups can be searched (see TLDatabase.search), but the exported HTML is static
             # Maybe launch a python script which searches for a message and creates an HTML with them
             # elif isinstance(e, MessageEntityHashtag)
             # elif isinstance(e, MessageEntityMention)
@@ -1,14 +1,23 @@
-from backuper import Backuper
+from time import sleep
+
+from backup_scheduler import BackupScheduler
 from utils import create_client
 
 
 def main(client):
     """Main method"""
-    '''
-    entity = client.get_dialogs(1)[1][0]
-    backuper = Backuper(client, entity)
-    backuper.start_backup()
-    '''
+    scheduler = BackupScheduler(client)
+    scheduler.start()
+    try:
+        while scheduler.is_running():
+            print(scheduler.get_progress())
+            sleep(5)
+    except KeyboardInterrupt:
+        print('Operation cancelled, stopping the backups!')
+        scheduler.stop()
+        scheduler.wait()
+
+    print(scheduler.get_progress())
 
 
 if __name__ == '__main__':
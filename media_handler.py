@@ -97,36 +97,93 @@ class MediaHandler:
     #region Message media file paths
 
     def get_msg_media_path(self, msg):
-        result = None
-        if isinstance(msg.media, MessageMediaPhoto):
-            result = path.join(self.directories['photos'], '{}{}'
-                               .format(msg.media.photo.id, get_extension(msg.media)))
-
-        if isinstance(msg.media, MessageMediaDocument):
-            media_type = None
-            for attr in msg.media.document.attributes:
+        """Gets the media full path for the given message, or None if its media is unsupported"""
+        relative_path = self.get_msg_media_relative_path(msg)
+        if relative_path:
+            return path.abspath(path.join(self.base_dir, relative_path))
+
+    def get_msg_media_relative_path(self, msg):
+        """Gets the media path for the given message, relative to the base directory"""
+        media_type = self.get_msg_media_type(msg)
+        if media_type == 'photos':
+            return path.join(MediaHandler.tree_structure[media_type], '{}{}'
+                             .format(msg.media.photo.id, get_extension(msg.media)))
+
+        if media_type:
+            return path.join(MediaHandler.tree_structure[media_type], '{}{}'
+                             .format(msg.media.document.id, get_extension(msg.media)))
+
+    @staticmethod
+    def get_msg_media_type(msg):
+        """Gets the media type (i.e. the tree structure key, such as 'photos' or
+           'videos') for the given message, or None if its media is unsupported"""
+        return MediaHandler.get_media_type(msg.media)
+
+    @staticmethod
+    def get_media_type(media):
+        """Gets the media type (i.e. the tree structure key, such as 'photos' or
+           'videos') for the given message media, or None if it's unsupported"""
+        if isinstance(media, MessageMediaPhoto):
+            return 'photos'
+
+        if isinstance(media, MessageMediaDocument):
+            for attr in media.document.attributes:
                 if isinstance(attr, DocumentAttributeAnimated):
-                    media_type = 'gifs'
-                    break
+                    return 'gifs'
                 if isinstance(attr, DocumentAttributeAudio):
-                    media_type = 'audios'
-                    break
+                    return 'audios'
                 if isinstance(attr, DocumentAttributeVideo):
-                    media_type = 'videos'
-                    break
+                    return 'videos'
                 if isinstance(attr, DocumentAttributeSticker):
-                    media_type = 'stickers'
-                    break
+                    return 'stickers'
                 if isinstance(attr, DocumentAttributeFilename):
-                    media_type = 'documents'
-                    break
-            if not media_type:
-                return None
+                    return 'documents'
+
+    #endregion
 
-            result = path.join(self.directories[media_type], '{}{}'
-                               .format(msg.media.document.id, get_extension(msg.media)))
-        if result:
-            return path.abspath(result)
+    #region Media information
+
+    @staticmethod
+    def get_media_dc_id(media):
+        """Returns the ID of the datacenter in which the given media is stored
+           (either a profile photo, or a message photo or document), or None if unknown"""
+        if isinstance(media, MessageMediaPhoto):
+            sizes = getattr(media.photo, 'sizes', None)
+            return getattr(getattr(sizes[-1], 'location', None), 'dc_id', None) if sizes else None
+
+        if isinstance(media, MessageMediaDocument):
+            return getattr(media.document, 'dc_id', None)
+
+        # Profile photos have the location of their big version
+        return getattr(getattr(media, 'photo_big', None), 'dc_id', None)
+
+    @staticmethod
+    def get_media_size(media):
+        """Returns the size in bytes of the given message media, or None if unknown"""
+        if isinstance(media, MessageMediaPhoto):
+            sizes = getattr(media.photo, 'sizes', None)
+            return getattr(sizes[-1], 'size', None) if sizes else None
+
+        if isinstance(media, MessageMediaDocument):
+            return getattr(media.document, 'size', None)
+
+    @staticmethod
+    def get_media_file_id(media):
+        """Returns the photo or document ID of the given message media, or None if it has none"""
+        if isinstance(media, MessageMediaPhoto):
+            return getattr(media.photo, 'id', None)
+
+        if isinstance(media, MessageMediaDocument):
+            return getattr(media.document, 'id', None)
+
+    @staticmethod
+    def get_media_mime_type(media):
+        """Returns the mime type of the given message media, or None if unknown"""
+        if isinstance(media, MessageMediaPhoto):
+            return 'image/jpeg'
+
+        if isinstance(media, MessageMediaDocument):
+            return getattr(media.document, 'mime_type', None)
 
     #endregion
 
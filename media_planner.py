@@ -0,0 +1,97 @@
+from datetime import datetime
+
+
+class MediaPlanner:
+    """Plans in which order the media of a backup is downloaded, across all
+       the kinds of media at once, so that if there is only a limited window
+       to download it (such as a night), the most valuable media comes first.
+
+       The plan is made by a single query over the columns describing the
+       media of every message, so no message needs to be loaded to make it.
+       The order is given as a list of policies, applied one after another
+       to break ties (for example, ('newest', 'smallest')). The media which is
+       still tied is grouped by datacenter, so the downloads don't need to switch
+       between the connections to different datacenters more than necessary"""
+
+    # The policies by which the media can be ordered, and their SQL ordering terms
+    policies = {
+        'newest': 'date desc',
+        'oldest': 'date asc',
+        'smallest': 'size asc',
+        'largest': 'size desc',
+        'type': 'type_priority asc',
+        'datacenter': 'dc_id asc'
+    }
+
+    # The media types (profile photos, and the tree structure keys of the
+    # message media) in the order they're downloaded by the 'type' policy
+    default_type_priority = ('propics', 'photos', 'documents', 'audios', 'videos', 'gifs', 'stickers')
+
+    #region Initialization
+
+    def __init__(self, order=('newest',), type_priority=None, deadline=None):
+        """
+        :param order:         The policies determining the download order, by their priority
+        :param type_priority: The media types used by the 'type' policy, by their priority.
+                              The media types not present here are downloaded last
+        :param deadline:      If specified, no more media is planned after this datetime
+        """
+        for policy in order:
+            if policy not in MediaPlanner.policies:
+                raise ValueError('Unknown media planning policy {}'.format(policy))
+
+        self.order = order
+        self.type_priority = type_priority if type_priority else MediaPlanner.default_type_priority
+        self.deadline = deadline
+
+    #endregion
+
+    #region Planning
+
+    def plan(self, db, queries, propic_size):
+        """Yields the (kind, ID, size) of the media to be downloaded, in the planned order.
+
+           The queries are a {kind: filters} dictionary, where the filters of 'propics'
+           apply to the users table (whose ID is yielded), and the filters of the rest
+           of kinds apply to the messages table (whose ID is yielded). Since the size of
+           the profile photos is unknown, the given size is used for all of them"""
+        selects = []
+        for kind, filters in queries.items():
+            if kind == 'propics':
+                selects.append("select 'propics' as kind, id, null as date, {} as size, "
+                               "null as dc_id, 'propics' as type from users {}"
+                               .format(int(propic_size), filters))
+            else:
+                selects.append("select '{}' as kind, id, date, media_size as size, "
+                               "media_dc_id as dc_id, media_type as type from messages {}"
+                               .format(kind, filters))
+
+        if not selects:
+            return
+
+        query = 'select kind, id, size from (select *, {} as type_priority from ({}))'.format(
+            self.get_type_priority_term(), ' union all '.join(selects))
+        query += ' order by {}'.format(', '.join(MediaPlanner.policies[p] for p in self.get_order()))
+
+        for row in db.query_rows(query):
+            if self.is_past_deadline():
+                return
+            yield row
+
+    def get_order(self):
+        """Returns the policies the plan is ordered by, which always end grouping by datacenter"""
+        if 'datacenter' in self.order:
+            return self.order
+        return tuple(self.order) + ('datacenter',)
+
+    def get_type_priority_term(self):
+        """Returns the SQL term evaluating to the priority of every media type"""
+        cases = ' '.join("when '{}' then {}".format(media_type, priority)
+                         for priority, media_type in enumerate(self.type_priority))
+        return 'case type {} else {} end'.format(cases, len(self.type_priority))
+
+    def is_past_deadline(self):
+        """Determines whether the deadline (if any) has already been reached"""
+        return self.deadline is not None and datetime.now() >= self.deadline
+
+    #endregion
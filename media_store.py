@@ -0,0 +1,167 @@
+import shutil
+from hashlib import sha256
+from os import path, makedirs, link, symlink, replace, remove
+from threading import get_ident, Lock
+
+from telethon.tl.types import MessageMediaPhoto, MessageMediaDocument
+
+
+class MediaStore:
+    """Content store shared by all the backups, so the same media (a sticker,
+       a forwarded video...) is only downloaded and stored once, no matter
+       how many dialogs it appears in.
+
+       Every file is stored under a key made from its photo or document ID,
+       alongside its checksum. The files of every backup are then hard links
+       (or symbolic links, or copies, if links aren't supported) to these"""
+
+    #region Initialization
+
+    def __init__(self, directory):
+        self.directory = directory
+
+        # The keys whose checksum was already verified by this instance
+        self.verified_keys = set()
+        self.lock = Lock()
+
+    #endregion
+
+    #region Keys and paths
+
+    @staticmethod
+    def get_key(media):
+        """Returns the key under which the given media (either a profile photo,
+           or a message photo or document) is stored, or None if it has none"""
+        if isinstance(media, MessageMediaPhoto):
+            return 'photo-{}'.format(media.photo.id)
+
+        if isinstance(media, MessageMediaDocument):
+            return 'document-{}'.format(media.document.id)
+
+        photo_id = getattr(media, 'photo_id', None)
+        if photo_id:
+            return 'propic-{}'.format(photo_id)
+
+    def get_path(self, key):
+        """Returns the path of the stored file for the given key"""
+        return path.join(self.directory, key)
+
+    def get_checksum_path(self, key):
+        """Returns the path of the file with the checksum for the given key"""
+        return path.join(self.directory, key + '.sha256')
+
+    #endregion
+
+    #region Checksums
+
+    @staticmethod
+    def calculate_checksum(file):
+        """Calculates the SHA-256 checksum of the given file, as a hex string"""
+        checksum = sha256()
+        with open(file, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(1024 * 1024), b''):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    def read_checksum(self, key):
+        """Reads the (checksum, size) stored for the given key, or (None, None)"""
+        checksum_file = self.get_checksum_path(key)
+        if not path.isfile(checksum_file):
+            return None, None
+
+        with open(checksum_file, 'r', encoding='utf-8') as file:
+            checksum, size = file.read().split()
+            return checksum, int(size)
+
+    #endregion
+
+    #region Storing and retrieving
+
+    def has(self, key):
+        """Determines whether the given key is stored. Only its size is checked
+           against the stored one, since this is cheap; see verify() otherwise"""
+        stored = self.get_path(key)
+        checksum, size = self.read_checksum(key)
+        return checksum is not None and path.isfile(stored) and path.getsize(stored) == size
+
+    def verify(self, key):
+        """Determines whether the given key is stored and its checksum is valid"""
+        checksum = self.read_checksum(key)[0]
+        return checksum is not None and path.isfile(self.get_path(key)) and \
+            self.calculate_checksum(self.get_path(key)) == checksum
+
+    def is_valid(self, key):
+        """Determines whether the given key is stored and valid. Its checksum is verified
+           the first time the key is checked by this instance, and only its size after
+           that. If the stored file turns out to be corrupt, it's removed from the store"""
+        with self.lock:
+            if key in self.verified_keys:
+                return self.has(key)
+
+        if not self.verify(key):
+            self.discard(key)
+            return False
+
+        with self.lock:
+            self.verified_keys.add(key)
+        return True
+
+    def discard(self, key):
+        """Removes the given key (and its checksum) from the store, if it was stored"""
+        with self.lock:
+            self.verified_keys.discard(key)
+
+        for file in (self.get_path(key), self.get_checksum_path(key)):
+            try:
+                remove(file)
+            except FileNotFoundError:
+                pass
+
+    def add(self, key, file):
+        """Adds the given (already downloaded) file to the store under the given key"""
+        if self.has(key):
+            return
+
+        makedirs(self.directory, exist_ok=True)
+
+        # Many backups may be adding the same key at once, so first
+        # write everything under unique names and then move them
+        temporary = self.get_path('{}.{}.tmp'.format(key, get_ident()))
+        self.link_or_copy(file, temporary, allow_symlink=False)
+        with open(temporary + '.sha256', 'w', encoding='utf-8') as checksum_file:
+            checksum_file.write('{} {}'.format(self.calculate_checksum(temporary),
+                                               path.getsize(temporary)))
+
+        replace(temporary + '.sha256', self.get_checksum_path(key))
+        replace(temporary, self.get_path(key))
+        with self.lock:
+            self.verified_keys.add(key)
+
+    def materialize(self, key, output):
+        """Makes the stored file for the given key available under the output path"""
+        if path.isfile(output):
+            remove(output)
+
+        makedirs(path.dirname(output), exist_ok=True)
+        self.link_or_copy(self.get_path(key), output)
+
+    @staticmethod
+    def link_or_copy(source, destination, allow_symlink=True):
+        """Hard links the source file to the destination, or if not possible,
+           symbolic links it (if allowed), or as a last resort, copies it"""
+        try:
+            link(source, destination)
+            return
+        except OSError:
+            pass
+
+        if allow_symlink:
+            try:
+                symlink(path.abspath(source), destination)
+                return
+            except OSError:
+                pass
+
+        shutil.copyfile(source, destination)
+
+    #endregion
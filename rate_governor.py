@@ -0,0 +1,127 @@
+from threading import Condition
+from time import monotonic
+
+from telethon.errors import FloodWaitError
+
+
+class RateGovernor:
+    """Token bucket which paces the requests made to Telegram.
+       It can (and should) be shared by everything using the same client.
+
+       The rate adapts itself AIMD-style: it slowly increases while requests
+       succeed, and it's cut down whenever Telegram tells us to wait because
+       of a flood error, in which case nobody is allowed to make any request
+       until the wait told by the server is over"""
+
+    #region Initialization
+
+    def __init__(self, rate=1, min_rate=0.05, max_rate=10,
+                 increase=0.05, decrease=0.5, burst=1):
+        """
+        :param rate:     The initial rate, in requests per second
+        :param min_rate: The rate will never go below this value
+        :param max_rate: The rate will never go above this value
+        :param increase: How much the rate increases after every successful request
+        :param decrease: By which factor the rate is multiplied after a flood error
+        :param burst:    How many requests can be made at once after being idle
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+
+        self.tokens = burst
+        self.last_refill = monotonic()
+
+        # Nobody can make requests until this (monotonic) time is reached
+        self.blocked_until = 0
+
+        # Some statistics
+        self.requests = 0
+        self.flood_waits = 0
+
+        self.condition = Condition()
+
+    #endregion
+
+    #region Acquiring
+
+    # How long we sleep at most before checking again whether we should still wait
+    max_sleep = 1
+
+    def acquire(self, running=None):
+        """Blocks until a request can be made. If a `running` function is
+           given and it returns False while waiting, False is returned"""
+        with self.condition:
+            while True:
+                now = monotonic()
+                self.refill(now)
+
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = (1 - self.tokens) / self.rate
+
+                if running and not running():
+                    return False
+
+                self.condition.wait(min(wait, RateGovernor.max_sleep))
+
+    def refill(self, now):
+        """Refills the bucket with the tokens gained since the last refill"""
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    #endregion
+
+    #region Adapting the rate
+
+    def on_success(self):
+        """Notifies that a request succeeded, so the rate is increased additively"""
+        with self.condition:
+            self.requests += 1
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_flood_wait(self, seconds):
+        """Notifies that Telegram told us to wait for the given seconds,
+           so the rate is decreased multiplicatively and everyone waits"""
+        with self.condition:
+            self.flood_waits += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+            # Refill first so the tokens gained until now don't get lost, and
+            # then empty the bucket so there is no burst after the wait is over
+            now = monotonic()
+            self.refill(now)
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def get_delay(self):
+        """Returns the current delay between requests, in seconds"""
+        return 1 / self.rate
+
+    #endregion
+
+    #region Invoking
+
+    def invoke(self, function, *args, running=None, **kwargs):
+        """Invokes function(*args, **kwargs) as soon as the rate allows it,
+           retrying after the server-provided wait if a flood error occurs.
+
+           If a `running` function is given and it returns False while
+           waiting, None is returned without invoking the function"""
+        while self.acquire(running=running):
+            try:
+                result = function(*args, **kwargs)
+            except FloodWaitError as e:
+                print('Flood wait, sleeping for {} seconds'.format(e.seconds))
+                self.on_flood_wait(e.seconds)
+            else:
+                self.on_success()
+                return result
+
+    #endregion
@@ -0,0 +1,34 @@
+import unittest
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from telethon.tl.types import Document, DocumentAttributeFilename, Message, MessageMediaDocument, \
+    PeerUser, PhotoSizeEmpty, User
+
+from backuper import Backuper
+from rate_governor import RateGovernor
+
+
+class BackupsTestCase(unittest.TestCase):
+    """Test case whose backups are all made in a temporary backups directory"""
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        patcher = mock.patch.object(Backuper, 'backups_dir', self.directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def make_backuper(self, client, entity_id=1, **kwargs):
+        """Makes a Backuper for the user with the given ID, which doesn't need to wait
+           between requests unless a rate_governor is given among the named arguments"""
+        kwargs.setdefault('rate_governor', RateGovernor(rate=1000, max_rate=1000, burst=1000))
+        return Backuper(client, User(id=entity_id), **kwargs)
+
+
+def make_document_message(msg_id, size=1024, dc_id=1):
+    document = Document(id=msg_id, access_hash=0, date=datetime(2017, 1, 1), mime_type='video/mp4',
+                        size=size, thumb=PhotoSizeEmpty(''), dc_id=dc_id, version=0,
+                        attributes=[DocumentAttributeFilename('{}.mp4'.format(msg_id))])
+    return Message(id=msg_id, to_id=PeerUser(1), date=datetime(2017, 1, 1), message='',
+                   media=MessageMediaDocument(document=document, caption=''))
@@ -0,0 +1,82 @@
+import json
+import unittest
+from os import path, makedirs, listdir
+
+from telethon.tl.types import User
+from telethon.tl.types.messages import MessagesSlice
+
+from backup_scheduler import BackupScheduler
+from tests.helpers import BackupsTestCase
+
+
+class FakeDialog:
+    def __init__(self, top_message):
+        self.top_message = top_message
+
+
+class FakeClient:
+    """Client whose dialogs are the given {user ID: top message}, all of them empty"""
+    def __init__(self, dialogs):
+        self.dialogs = dialogs
+
+    def get_dialogs(self, limit):
+        return ([FakeDialog(top) for top in self.dialogs.values()],
+                [User(id=entity_id) for entity_id in self.dialogs])
+
+    def connect(self):
+        pass
+
+    def invoke(self, request):
+        return MessagesSlice(count=0, messages=[], chats=[], users=[])
+
+
+class TestBackupScheduler(BackupsTestCase):
+    def export_metadata(self, entity_id, **metadata):
+        backup_dir = path.join(self.directory.name, str(entity_id))
+        makedirs(backup_dir)
+        with open(path.join(backup_dir, 'metadata.json'), 'w', encoding='utf-8') as file:
+            json.dump(metadata, file)
+
+    def test_plan_by_priority_without_making_backupers(self):
+        self.export_metadata(1, last_msg_id=100, saved_msgs=100, total_msgs=100)
+        self.export_metadata(2, last_msg_id=90, saved_msgs=90, total_msgs=90)
+        scheduler = BackupScheduler(FakeClient({1: 100, 2: 100, 3: 50}))
+        scheduler.plan()
+
+        self.assertEqual([entity.id for entity in scheduler.skipped], [1])
+        self.assertEqual([entity.id for _, _, entity in sorted(scheduler.pending)], [3, 2])
+
+        # No backup was prepared yet, so there's no new directory either
+        self.assertEqual(sorted(listdir(self.directory.name)), ['1', '2'])
+
+    def test_backupers_share_the_media_store(self):
+        scheduler = BackupScheduler(FakeClient({1: 100, 2: 100}))
+        scheduler.start()
+        scheduler.wait()
+
+        self.assertEqual(len(scheduler.done), 2)
+        for backuper in scheduler.done:
+            self.assertIs(backuper.media_store, scheduler.media_store)
+
+    def test_byte_budget(self):
+        scheduler = BackupScheduler(FakeClient({}), byte_budget=1000)
+        scheduler.start()
+        scheduler.wait()
+        self.assertFalse(scheduler.is_budget_exhausted())
+
+        scheduler.bandwidth_governor.acquire(1000)
+        self.assertTrue(scheduler.is_budget_exhausted())
+        self.assertEqual(scheduler.get_progress()['downloaded_bytes'], 1000)
+
+    def test_request_budget(self):
+        scheduler = BackupScheduler(FakeClient({}), request_budget=1)
+        scheduler.start()
+        scheduler.wait()
+        self.assertFalse(scheduler.is_budget_exhausted())
+
+        scheduler.rate_governor.invoke(lambda: None)
+        self.assertTrue(scheduler.is_budget_exhausted())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from datetime import datetime
+
+from telethon.tl.types import Message, PeerUser
+from telethon.tl.types.messages import MessagesSlice
+
+from tests.helpers import BackupsTestCase
+from tl_database import TLDatabase
+
+
+def make_message(msg_id):
+    return Message(id=msg_id, to_id=PeerUser(1), date=datetime(2017, 1, 1), message='')
+
+
+class FakeClient:
+    """Client whose history only has the given message IDs, remembering every request"""
+    def __init__(self, msg_ids):
+        self.msg_ids = msg_ids
+        self.requests = []
+
+    def connect(self):
+        pass
+
+    def invoke(self, request):
+        self.requests.append((request.min_id, request.max_id))
+        top_id = request.offset_id or request.max_id
+        msg_ids = sorted((msg_id for msg_id in self.msg_ids
+                          if request.min_id < msg_id < top_id), reverse=True)
+        msgs = [make_message(msg_id) for msg_id in msg_ids[:request.limit]]
+        return MessagesSlice(count=len(self.msg_ids), messages=msgs, chats=[], users=[])
+
+
+class TestRefillGaps(BackupsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backup_dir = self.make_backuper(None).backup_dir
+        with TLDatabase(self.backup_dir) as db:
+            db.add_objects([make_message(msg_id) for msg_id in (1, 10, 20)])
+            db.commit()
+
+    def refill_gaps(self, client):
+        self.make_backuper(client, download_chunk_size=10).refill_gaps_thread()
+
+    def test_empty_gaps_are_not_requested_again(self):
+        # Message 5 is still there, but the rest of the gaps were deleted
+        client = FakeClient([1, 5, 10, 20])
+        self.refill_gaps(client)
+        self.assertEqual(client.requests, [(1, 10), (10, 20)])
+
+        with TLDatabase(self.backup_dir) as db:
+            self.assertEqual(db.count('messages'), 4)
+            self.assertEqual(db.find_gaps('messages', skip_empty=True), [])
+            self.assertEqual(len(db.find_gaps('messages')), 3)
+
+        client = FakeClient([1, 5, 10, 20])
+        self.refill_gaps(client)
+        self.assertEqual(client.requests, [])
+
+    def test_new_gaps_are_still_requested(self):
+        self.refill_gaps(FakeClient([1, 10, 20]))
+        with TLDatabase(self.backup_dir) as db:
+            db.add_objects([make_message(30)])
+            db.commit()
+
+        client = FakeClient([1, 10, 20, 30])
+        self.refill_gaps(client)
+        self.assertEqual(client.requests, [(20, 30)])
+
+
+if __name__ == '__main__':
+    unittest.main()
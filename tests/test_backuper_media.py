@@ -0,0 +1,233 @@
+import unittest
+from datetime import datetime
+from os import path, listdir
+from queue import Queue
+from threading import Thread, current_thread, Lock
+from unittest import mock
+
+from telethon.tl.types.storage import FileMp4
+from telethon.tl.types.upload import File, FileCdnRedirect
+
+import backuper
+from backuper import Backuper
+from eta_estimator import EtaEstimator
+
+from tests.helpers import BackupsTestCase, make_document_message
+from tl_database import TLDatabase
+
+
+def connection_reset(*args, **kwargs):
+    raise ConnectionResetError('Connection reset by peer')
+
+
+def make_file(offset, limit, size):
+    """Makes the part of a file of the given size, whose every byte is its offset % 256"""
+    data = bytes(i % 256 for i in range(offset, min(offset + limit, size)))
+    return File(type=FileMp4(), mtime=datetime(2017, 1, 1), bytes=data)
+
+
+class FakeConnection:
+    """Connection whose files are made by make_file, remembering from which threads it's used"""
+    def __init__(self, size=1024, cdn=False):
+        self.size = size
+        self.cdn = cdn
+        self.threads = set()
+        self.offsets = []
+        self.connected = True
+        self._cached_clients = {}
+
+    def invoke(self, request):
+        self.threads.add(current_thread())
+        self.offsets.append(request.offset)
+        if self.cdn:
+            return FileCdnRedirect(dc_id=1, file_token=b'', encryption_key=b'',
+                                   encryption_iv=b'', cdn_file_hashes=[])
+        return make_file(request.offset, request.limit, self.size)
+
+    def disconnect(self):
+        self.connected = False
+
+
+class FakeCdnDecrypter:
+    """CDN decrypter whose files are made by make_file"""
+    def __init__(self, size):
+        self.size = size
+        self.offsets = []
+        self.checked = False
+        self.client = FakeConnection()
+
+    def prepare_decrypter(self, client, client_cls, cdn_redirect, offset, part_size):
+        return self, self.get_file(offset, part_size)
+
+    def get_file(self, offset, limit):
+        self.offsets.append(offset)
+        return make_file(offset, limit, self.size)
+
+    def finish_check(self):
+        self.checked = True
+
+
+class RecordingEtaEstimator(EtaEstimator):
+    """EtaEstimator remembering every update it's given"""
+    updates = []
+
+    def update(self, items=1, size=0):
+        RecordingEtaEstimator.updates.append((items, size))
+        super().update(items=items, size=size)
+
+
+class FakeClient:
+    """Client which can't be invoked, only make new connections"""
+    def __init__(self):
+        self.connections = []
+        self.lock = Lock()
+
+    def invoke(self, request):
+        raise AssertionError('The media must be downloaded through new connections')
+
+    def create_new_connection(self):
+        with self.lock:
+            self.connections.append(FakeConnection())
+            return self.connections[-1]
+
+
+class TestMediaBackup(BackupsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backuper = self.make_backuper(None)
+        with TLDatabase(self.backuper.backup_dir) as db:
+            db.add_objects([make_document_message(msg_id) for msg_id in range(1, 21)])
+            db.commit()
+
+    def backup_media(self, **kwargs):
+        thread = Thread(target=self.backuper.backup_media_thread, daemon=True,
+                        kwargs=dict(dict(dl_propics=False, dl_photos=False, dl_docs=True), **kwargs))
+        thread.start()
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+
+    def get_statuses(self):
+        with TLDatabase(self.backuper.backup_dir) as db:
+            return [status for status, in db.con.execute('select status from media order by msg_id')]
+
+    def test_media_is_fed_by_datacenter(self):
+        with TLDatabase(self.backuper.backup_dir) as db:
+            db.add_objects([make_document_message(msg_id, dc_id=msg_id % 3 + 1)
+                            for msg_id in range(21, 41)], replace=True)
+            db.commit()
+
+        queue = Queue()
+        self.backuper.backup_running = True
+        self.backuper.media_feeder_thread(queue, 'docs', worker_count=2)
+        items = list(iter(queue.get, None))
+
+        dc_ids = [item['media'].document.dc_id for item in items]
+        self.assertEqual(len(dc_ids), 40)
+        self.assertEqual(dc_ids, sorted(dc_ids))
+        self.assertIsNone(queue.get_nowait())
+
+    def test_every_worker_has_its_own_connection(self):
+        client = FakeClient()
+        self.backuper.client = client
+        self.backup_media(workers={'docs': 2})
+
+        self.assertEqual(self.get_statuses(), ['downloaded'] * 20)
+        self.assertLessEqual(len(client.connections), 2)
+        for connection in client.connections:
+            self.assertEqual(len(connection.threads), 1)
+            self.assertFalse(connection.connected)
+
+        threads = [thread for connection in client.connections for thread in connection.threads]
+        self.assertEqual(len(threads), len(set(threads)))
+
+    def test_only_downloads_count_towards_the_rate(self):
+        self.backuper.client = FakeClient()
+        self.backup_media(workers={'docs': 2})
+
+        # Now everything is present already, which takes no time at all
+        RecordingEtaEstimator.updates = []
+        with TLDatabase(self.backuper.backup_dir) as db:
+            db.con.execute('delete from media')
+            db.commit()
+        with mock.patch.object(backuper, 'EtaEstimator', RecordingEtaEstimator):
+            self.backup_media(workers={'docs': 2})
+
+        self.assertEqual(self.get_statuses(), ['downloaded'] * 20)
+        self.assertEqual(RecordingEtaEstimator.updates, [])
+
+    def test_workers_survive_any_error(self):
+        self.backuper.client = FakeClient()
+        self.backuper.download_document = connection_reset
+        self.backup_media(workers={'docs': 2})
+        self.assertEqual(self.get_statuses(), ['failed'] * 20)
+
+
+
+class TestDownloadDocument(BackupsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backuper = self.make_backuper(None)
+        self.backuper.backup_running = True
+        self.output = path.join(self.backuper.backup_dir, 'document.mp4')
+        self.progress = []
+
+    def download_document(self, connection, size):
+        media = make_document_message(1, size=size).media
+        self.backuper.download_document(connection, media, self.output,
+                                        progress_callback=lambda *args: self.progress.append(args))
+
+    def assert_downloaded(self, size):
+        with open(self.output, 'rb') as file:
+            self.assertEqual(file.read(), make_file(0, size, size).bytes)
+        self.assertEqual(listdir(self.backuper.backup_dir).count('document.mp4.part'), 0)
+        self.assertEqual(listdir(self.backuper.backup_dir).count('document.mp4.part.offset'), 0)
+
+    def test_empty_document(self):
+        self.download_document(FakeConnection(size=0), size=0)
+        self.assert_downloaded(0)
+
+    def write_part(self, offset, size):
+        with open(self.output + '.part', 'wb') as file:
+            file.write(make_file(0, offset, size).bytes)
+        with open(self.output + '.part.offset', 'w') as file:
+            file.write(str(offset))
+
+    def test_resume_only_reports_the_new_bytes(self):
+        part_size = Backuper.download_part_size
+        size = part_size * 3
+        self.write_part(part_size * 2, size)
+
+        connection = FakeConnection(size=size)
+        self.download_document(connection, size=size)
+        self.assert_downloaded(size)
+        self.assertEqual(connection.offsets, [part_size * 2])
+        self.assertEqual(self.progress, [(part_size, part_size)])
+
+    def test_cdn_document(self):
+        size = Backuper.download_part_size * 2 + 1
+        decrypter = FakeCdnDecrypter(size)
+        with mock.patch.object(backuper, 'CdnDecrypter', decrypter):
+            self.download_document(FakeConnection(size=size, cdn=True), size=size)
+
+        self.assert_downloaded(size)
+        self.assertEqual(decrypter.offsets, [0, Backuper.download_part_size, Backuper.download_part_size * 2])
+        self.assertTrue(decrypter.checked)
+        self.assertFalse(decrypter.client.connected)
+
+    def test_cdn_document_starts_over(self):
+        size = Backuper.download_part_size * 2
+        self.write_part(Backuper.download_part_size, size)
+
+        decrypter = FakeCdnDecrypter(size)
+        connection = FakeConnection(size=size, cdn=True)
+        with mock.patch.object(backuper, 'CdnDecrypter', decrypter):
+            self.download_document(connection, size=size)
+
+        self.assert_downloaded(size)
+        self.assertEqual(connection.offsets, [Backuper.download_part_size, 0])
+        self.assertEqual(decrypter.offsets, [0, Backuper.download_part_size])
+        self.assertEqual(self.progress[-1], (size, size))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import sqlite3
+import sys
+import unittest
+from datetime import datetime
+from threading import Thread
+from time import sleep
+from unittest import mock
+
+from telethon.tl.types import Message, PeerUser
+from telethon.tl.types.messages import MessagesSlice
+
+import backuper
+from tests.helpers import BackupsTestCase
+from tl_database import TLDatabase
+
+
+class FakeClient:
+    """Client which returns full chunks of messages, walking back forever"""
+    def connect(self):
+        pass
+
+    def invoke(self, request):
+        top_id = request.offset_id if request.offset_id else 1000000
+        msgs = [Message(id=msg_id, to_id=PeerUser(1), date=datetime(2017, 1, 1), message='')
+                for msg_id in range(top_id - 1, top_id - 1 - request.limit, -1)]
+        return MessagesSlice(count=1000000, messages=msgs, chats=[], users=[])
+
+
+class EmptyClient:
+    """Client whose every history is empty"""
+    def connect(self):
+        pass
+
+    def invoke(self, request):
+        return MessagesSlice(count=0, messages=[], chats=[], users=[])
+
+
+def locked_database(*args, **kwargs):
+    # Give the fetcher time to fill the queue before failing
+    sleep(0.5)
+    raise sqlite3.OperationalError('database is locked')
+
+
+class TestBackuperPipeline(BackupsTestCase):
+    def test_fetcher_ends_if_the_database_cant_be_opened(self):
+        instance = self.make_backuper(FakeClient(), download_chunk_size=10, max_pending_chunks=1)
+        with mock.patch.object(backuper, 'TLDatabase', locked_database):
+            thread = Thread(target=instance.backup_messages_thread, daemon=True)
+            thread.start()
+            thread.join(timeout=10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(instance.is_backup_running())
+
+
+    def test_messages_are_saved_with_the_storage_profile(self):
+        instance = self.make_backuper(EmptyClient(), storage_profile='bulk')
+        profiles = {}
+
+        def database(backup_dir, storage_profile='default'):
+            # Remember which method opened the database, with which profile
+            profiles[sys._getframe(1).f_code.co_name] = storage_profile
+            return TLDatabase(backup_dir, storage_profile=storage_profile)
+
+        with mock.patch.object(backuper, 'TLDatabase', database):
+            for target in (instance.backup_messages_thread, instance.sync_messages_thread,
+                           instance.refill_gaps_thread, instance.resync_edits_thread):
+                thread = Thread(target=target)
+                thread.start()
+                thread.join()
+
+        for name in ('backup_messages_writer_thread', 'sync_messages_thread',
+                     'refill_gaps_thread', 'resync_edits_thread'):
+            self.assertEqual(profiles.get(name), 'bulk', name)
+
+
+if __name__ == '__main__':
+    unittest.main()
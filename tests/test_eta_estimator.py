@@ -0,0 +1,33 @@
+import unittest
+from unittest import mock
+
+import eta_estimator
+from eta_estimator import EtaEstimator
+
+
+class TestEtaEstimator(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        patcher = mock.patch.object(eta_estimator, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_estimates_from_the_bytes_rate(self):
+        estimator = EtaEstimator(total_bytes=1000)
+        self.now = 1
+        estimator.update(items=1, size=100)
+        self.assertEqual(estimator.get_etl().total_seconds(), 9)
+
+    def test_skipped_work_is_done_but_not_fast(self):
+        estimator = EtaEstimator(total_bytes=1000)
+        estimator.skip(items=5, size=500)
+        self.now = 1
+        estimator.update(items=1, size=100)
+
+        # 400 bytes are left at 100 bytes per second
+        self.assertEqual(estimator.done_bytes, 600)
+        self.assertEqual(estimator.get_etl().total_seconds(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
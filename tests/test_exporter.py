@@ -0,0 +1,49 @@
+import unittest
+from os import path, makedirs
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from telethon.tl.types import User
+
+from exporter.exporter import Exporter
+from media_handler import MediaHandler
+from tests.helpers import make_document_message
+from tl_database import TLDatabase
+
+
+class TestExporter(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        patcher = mock.patch.object(Exporter, 'export_dir', path.join(self.directory.name, 'exported'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.backup_dir = path.join(self.directory.name, '1')
+        self.msg = make_document_message(1)
+        self.msg.from_id = 1
+        self.relative_path = MediaHandler(self.backup_dir).get_msg_media_relative_path(self.msg)
+        with TLDatabase(self.backup_dir) as db:
+            db.add_objects([User(id=1, first_name='User'), self.msg])
+            db.set_media(msg_id=1, media_id=1, kind='videos', relative_path=self.relative_path,
+                         expected_size=1024, downloaded_size=1024, checksum=None, status='downloaded')
+            db.commit()
+
+    def export(self):
+        exporter = Exporter(self.backup_dir, 'export')
+        exporter.export_thread(callback=lambda progress: None)
+        return path.join(exporter.output_dir, self.relative_path)
+
+    def test_downloaded_media_is_copied(self):
+        makedirs(path.dirname(path.join(self.backup_dir, self.relative_path)))
+        with open(path.join(self.backup_dir, self.relative_path), 'wb') as file:
+            file.write(bytes(1024))
+
+        self.assertTrue(path.isfile(self.export()))
+
+    def test_deleted_media_is_skipped(self):
+        self.assertFalse(path.isfile(self.export()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+
+from media_planner import MediaPlanner
+from tl_database import TLDatabase
+
+PHOTO_ID = 1
+DOCUMENT_ID = 2
+
+
+class TestMediaPlanner(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.db = TLDatabase(self.directory.name)
+
+        # (id, date, media_id, media_size, media_type, media_dc_id)
+        messages = [
+            (1, datetime(2017, 1, 1), PHOTO_ID, 300, 'photos', 2),
+            (2, datetime(2017, 1, 2), DOCUMENT_ID, 100, 'videos', 4),
+            (3, datetime(2017, 1, 3), PHOTO_ID, 200, 'photos', 2),
+            (4, datetime(2017, 1, 4), DOCUMENT_ID, 50, 'documents', 1)
+        ]
+        self.db.con.executemany(
+            'insert into messages (id, date, media_id, media_size, media_type, media_dc_id) '
+            'values (?, ?, ?, ?, ?, ?)', messages)
+        self.db.con.execute("insert into users (id, photo) values (10, x'00')")
+        self.db.commit()
+
+        self.queries = {
+            'photos': 'where media_id = {}'.format(PHOTO_ID),
+            'docs': 'where media_id = {}'.format(DOCUMENT_ID)
+        }
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def plan(self, planner, queries=None):
+        return list(planner.plan(self.db, queries if queries else self.queries, propic_size=10))
+
+    def test_plan_without_propics(self):
+        self.assertEqual(self.plan(MediaPlanner(order=('newest',))),
+                         [('docs', 4, 50), ('photos', 3, 200), ('docs', 2, 100), ('photos', 1, 300)])
+
+    def test_plan_with_propics(self):
+        queries = dict(self.queries, propics='where photo not null')
+        self.assertEqual(self.plan(MediaPlanner(order=('smallest',)), queries),
+                         [('propics', 10, 10), ('docs', 4, 50), ('docs', 2, 100),
+                          ('photos', 3, 200), ('photos', 1, 300)])
+
+    def test_plan_by_type(self):
+        planner = MediaPlanner(order=('type', 'oldest'), type_priority=('videos', 'photos'))
+        self.assertEqual([row[1] for row in self.plan(planner)], [2, 1, 3, 4])
+
+    def test_ties_are_grouped_by_datacenter(self):
+        ids = [row[1] for row in self.plan(MediaPlanner(order=()))]
+        self.assertEqual(ids[0], 4)
+        self.assertEqual(sorted(ids[1:3]), [1, 3])
+        self.assertEqual(ids[3], 2)
+
+    def test_plan_after_deadline(self):
+        planner = MediaPlanner(deadline=datetime.now() - timedelta(seconds=1))
+        self.assertEqual(self.plan(planner), [])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            MediaPlanner(order=('random',))
+
+
+if __name__ == '__main__':
+    unittest.main()
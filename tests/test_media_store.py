@@ -0,0 +1,51 @@
+import unittest
+from os import path
+from tempfile import TemporaryDirectory
+
+from media_store import MediaStore
+
+
+class TestMediaStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.store = MediaStore(path.join(self.directory.name, 'store'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        file = path.join(self.directory.name, name)
+        with open(file, 'wb') as handle:
+            handle.write(data)
+        return file
+
+    def read(self, file):
+        with open(file, 'rb') as handle:
+            return handle.read()
+
+    def test_add_and_materialize(self):
+        self.store.add('photo-1', self.write('downloaded', b'photo'))
+        self.assertTrue(MediaStore(self.store.directory).is_valid('photo-1'))
+
+        output = path.join(self.directory.name, 'other', 'photo.jpg')
+        self.store.materialize('photo-1', output)
+        self.assertEqual(self.read(output), b'photo')
+
+    def test_corrupt_file_is_discarded(self):
+        self.store.add('photo-1', self.write('downloaded', b'photo'))
+
+        # Same size, different contents, so only the checksum can tell
+        with open(self.store.get_path('photo-1'), 'wb') as handle:
+            handle.write(b'PHOTO')
+
+        store = MediaStore(self.store.directory)
+        self.assertFalse(store.is_valid('photo-1'))
+        self.assertFalse(path.isfile(self.store.get_path('photo-1')))
+        self.assertFalse(path.isfile(self.store.get_checksum_path('photo-1')))
+
+    def test_missing_key(self):
+        self.assertFalse(self.store.is_valid('document-1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
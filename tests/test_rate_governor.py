@@ -0,0 +1,91 @@
+import unittest
+from time import monotonic
+
+from telethon.errors import FloodWaitError
+
+from rate_governor import RateGovernor
+
+
+def flood_wait(seconds):
+    """Makes a FloodWaitError telling to wait the given seconds. Its constructor
+       changed between Telethon versions, so it's not used to make the error"""
+    error = FloodWaitError.__new__(FloodWaitError)
+    error.seconds = seconds
+    return error
+
+
+class FakeClient:
+    """Client whose invoke() raises the given flood errors (one per call, or None
+       to succeed) before succeeding, remembering when every call was made"""
+    def __init__(self, flood_waits=()):
+        self.flood_waits = list(flood_waits)
+        self.calls = []
+
+    def invoke(self, request):
+        self.calls.append(monotonic())
+        if self.flood_waits:
+            seconds = self.flood_waits.pop(0)
+            if seconds is not None:
+                raise flood_wait(seconds)
+        return request
+
+
+class TestRateGovernor(unittest.TestCase):
+    def test_waits_as_told_by_the_server(self):
+        governor = RateGovernor(rate=10, max_rate=10)
+        client = FakeClient(flood_waits=[0.5])
+
+        self.assertEqual(governor.invoke(client.invoke, 'request'), 'request')
+        self.assertEqual(len(client.calls), 2)
+        self.assertGreaterEqual(client.calls[1] - client.calls[0], 0.5)
+        self.assertEqual(governor.flood_waits, 1)
+        self.assertEqual(governor.requests, 1)
+
+    def test_rate_halves_and_recovers(self):
+        governor = RateGovernor(rate=10, max_rate=10, increase=1, decrease=0.5, burst=100)
+        governor.tokens = 100
+
+        governor.on_flood_wait(0)
+        self.assertEqual(governor.rate, 5)
+
+        client = FakeClient()
+        for expected_rate in (6, 7, 8, 9, 10, 10):
+            governor.invoke(client.invoke, 'request')
+            self.assertEqual(governor.rate, expected_rate)
+
+    def test_rate_never_goes_below_the_minimum(self):
+        governor = RateGovernor(rate=1, min_rate=0.5, decrease=0.1)
+        governor.on_flood_wait(0)
+        self.assertEqual(governor.rate, 0.5)
+
+    def test_everyone_waits_after_a_flood_error(self):
+        governor = RateGovernor(rate=100, burst=100)
+        governor.tokens = 100
+        governor.on_flood_wait(0.5)
+
+        start = monotonic()
+        self.assertTrue(governor.acquire())
+        self.assertGreaterEqual(monotonic() - start, 0.5)
+
+    def test_stopping_aborts_the_wait(self):
+        governor = RateGovernor()
+        governor.on_flood_wait(60)
+        client = FakeClient()
+
+        start = monotonic()
+        self.assertIsNone(governor.invoke(client.invoke, 'request', running=lambda: False))
+        self.assertLess(monotonic() - start, RateGovernor.max_sleep)
+        self.assertEqual(client.calls, [])
+
+    def test_stopping_during_repeated_flood_errors(self):
+        governor = RateGovernor(rate=100, burst=100)
+        client = FakeClient(flood_waits=[0.1, 60])
+        running = lambda: len(client.calls) < 2
+
+        self.assertIsNone(governor.invoke(client.invoke, 'request', running=running))
+        self.assertEqual(len(client.calls), 2)
+        self.assertEqual(governor.flood_waits, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import sqlite3
+import unittest
+from os import path
+from tempfile import TemporaryDirectory
+
+from tests.helpers import make_document_message
+from tl_database import TLDatabase
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def make_old_database(self):
+        """Makes a database with the messages table of the backups made before the schema
+           was versioned, with a single message with a document, as these saved it"""
+        with TLDatabase(self.directory.name) as db:
+            msg = make_document_message(1, size=2048, dc_id=4)
+            row = db.get_message_row(msg)
+
+        con = sqlite3.connect(path.join(self.directory.name, 'db.sqlite'))
+        con.execute('drop table messages')
+        con.execute('''create table messages (id integer primary key, message text, from_id integer,
+                       out bool, date timestamp, edit_date timestamp, fwd_from text,
+                       via_bot_id integer, reply_to_msg_id integer, media blob, media_id integer,
+                       entities blob, action blob, action_id integer)''')
+        con.execute('insert into messages values ({})'.format(', '.join('?' * 14)), row[:14])
+        con.execute('pragma user_version = 0')
+        con.commit()
+        con.close()
+
+    def test_old_databases_are_migrated(self):
+        self.make_old_database()
+        with TLDatabase(self.directory.name) as db:
+            self.assertEqual(db.get_schema_version(), len(TLDatabase.migrations))
+            self.assertEqual(db.con.execute('select media_size, media_type, media_dc_id '
+                                            'from messages').fetchall(), [(2048, 'documents', 4)])
+            self.assertEqual(list(db.search('hello')), [])
+
+    def test_interrupted_migration_is_redone(self):
+        self.make_old_database()
+        with TLDatabase(self.directory.name) as db:
+            # As if the media columns were added, but the process died before filling them
+            db.con.execute('update messages set media_size = null, media_type = null, media_dc_id = null')
+            db.con.execute('pragma user_version = {}'.format(
+                TLDatabase.migrations.index(TLDatabase.migrate_media_columns)))
+            db.commit()
+
+        with TLDatabase(self.directory.name) as db:
+            self.assertEqual(db.con.execute('select media_size, media_type, media_dc_id '
+                                            'from messages').fetchall(), [(2048, 'documents', 4)])
+
+    def test_new_databases_are_up_to_date(self):
+        with TLDatabase(self.directory.name) as db:
+            self.assertEqual(db.get_schema_version(), len(TLDatabase.migrations))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+from datetime import datetime
+from tempfile import TemporaryDirectory
+
+from tl_database import TLDatabase
+
+
+class TestMessageSearch(unittest.TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.db = TLDatabase(self.directory.name)
+
+    def tearDown(self):
+        self.db.close()
+        self.directory.cleanup()
+
+    def save_message(self, msg_id, message, from_id=1, date=datetime(2017, 1, 1)):
+        self.db.con.execute('insert or replace into messages (id, message, from_id, date) '
+                            'values (?, ?, ?, ?)', (msg_id, message, from_id, date))
+        self.db.commit()
+
+    def assert_index_intact(self):
+        # Raises "database disk image is malformed" if the index doesn't match the messages
+        self.db.con.execute("insert into messages_search (messages_search) values ('integrity-check')")
+
+        # Only the messages with text may be indexed, or the triggers could never remove them
+        indexed = self.db.con.execute('select count(*) from messages_search_docsize').fetchone()[0]
+        self.assertEqual(indexed, self.db.count('messages where message not null'))
+
+    def search_ids(self, text, **kwargs):
+        return [msg.id for msg in self.db.search(text, **kwargs)]
+
+    def test_caption_added_to_message_without_text(self):
+        self.save_message(1, None)
+        self.save_message(2, 'hello there')
+        self.save_message(1, 'hello again')
+
+        self.assert_index_intact()
+        self.assertEqual(sorted(self.search_ids('hello')), [1, 2])
+
+    def test_replaced_text_is_not_found(self):
+        self.save_message(1, 'old caption')
+        self.save_message(1, 'new caption')
+
+        self.assert_index_intact()
+        self.assertEqual(self.search_ids('old'), [])
+        self.assertEqual(self.search_ids('new'), [1])
+
+    def test_filters_and_paging(self):
+        self.save_message(1, 'hello', from_id=1, date=datetime(2017, 1, 1))
+        self.save_message(2, 'hello', from_id=2, date=datetime(2017, 1, 2))
+        self.save_message(3, 'hello', from_id=1, date=datetime(2017, 1, 3))
+
+        self.assertEqual(sorted(self.search_ids('hello', from_id=1)), [1, 3])
+        self.assertEqual(self.search_ids('hello', after_date=datetime(2017, 1, 2),
+                                         before_date=datetime(2017, 1, 2)), [2])
+        self.assertEqual(len(self.search_ids('hello', limit=2)), 2)
+        self.assertEqual(len(self.search_ids('hello', limit=2, offset=2)), 1)
+
+    def test_existing_messages_are_indexed(self):
+        self.save_message(1, None)
+        self.save_message(2, 'hello')
+        self.save_message(3, None)
+
+        # As if the messages were saved before the index existed
+        for trigger in ('insert', 'delete', 'update'):
+            self.db.con.execute('drop trigger messages_search_{}'.format(trigger))
+        self.db.con.execute('drop table messages_search')
+        self.db.con.execute('pragma user_version = {}'.format(
+            TLDatabase.migrations.index(TLDatabase.migrate_message_search)))
+        self.db.commit()
+        self.db.close()
+
+        self.db = TLDatabase(self.directory.name)
+        self.save_message(1, 'hello again')
+
+        self.assert_index_intact()
+        self.assertEqual(sorted(self.search_ids('hello')), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
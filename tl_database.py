@@ -1,4 +1,7 @@
+import json
 import sqlite3
+from collections import namedtuple
+from hashlib import sha1
 
 from os import path, makedirs
 
@@ -11,13 +14,56 @@ from telethon.tl.types import \
 
 from telethon.extensions import BinaryReader, BinaryWriter
 
+from media_handler import MediaHandler
+
 
 class TLDatabase:
 
+    # SQLite limits how many parameters ("?") a single statement may have
+    max_query_params = 999
+
+    # The tables whose rows are remembered by their fingerprint, to skip rewriting them
+    fingerprinted_tables = ('users', 'chats', 'channels')
+
+    # The operators which can be used by the filters of select()
+    filter_operators = ('=', '!=', '<', '<=', '>', '>=', 'like', 'in', 'not in', 'is', 'is not')
+
+    # How many rows are fetched at once when streaming the results of a query
+    fetch_batch_size = 1000
+
+    # The storage profiles a database can be opened with, as the {pragma: value} applied
+    # (in order) to every connection. The page size only applies to new databases.
+    #
+    # With write-ahead logging, readers don't block the writer (and vice versa), and a
+    # commit doesn't need to sync the whole database. The 'default' profile survives both
+    # application and operating system crashes (although the last commits may be lost on
+    # a power loss). The 'bulk' profile doesn't sync at all, so it's faster, but an
+    # operating system crash or a power loss may corrupt the whole database. It should
+    # only be used for backups which can be made again from scratch
+    storage_profiles = {
+        'default': {
+            'page_size': 4096,
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'cache_size': -8 * 1024,  # In KB when negative
+            'mmap_size': 64 * 1024 * 1024
+        },
+        'bulk': {
+            'page_size': 4096,
+            'journal_mode': 'wal',
+            'synchronous': 'off',
+            'cache_size': -64 * 1024,
+            'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 'memory'
+        }
+    }
+
     #region Initialization
 
-    def __init__(self, directory):
-        """Loads (or creates) a TLDatabase (for storing TLObjects) for the given file path"""
+    def __init__(self, directory, storage_profile='default'):
+        """Loads (or creates) a TLDatabase (for storing TLObjects) for the given file path.
+           The storage profile is either the name of one of TLDatabase.storage_profiles,
+           or a {pragma: value} dictionary itself"""
 
         # Register adapters and converters
         sqlite3.register_adapter(bool, self.adapt_boolean)
@@ -27,6 +73,21 @@ class TLDatabase:
         makedirs(directory, exist_ok=True)
         self.con = sqlite3.connect(path.join(directory, 'db.sqlite'),
                                    detect_types=sqlite3.PARSE_DECLTYPES)
+        self.apply_storage_profile(storage_profile)
+
+        # Replacing a row must fire its delete triggers too, or the search index
+        # would keep the text of the messages that were replaced
+        self.con.execute('pragma recursive_triggers = on')
+
+        # The same users and chats are received over and over again, so remember the
+        # fingerprint of the rows written through this connection, and how many
+        # writes were skipped because the row we had was exactly the same
+        self.fingerprints = {}
+        self.elided_writes = 0
+
+        # The {table name: columns} and {columns: row class} used by select()
+        self.table_columns = {}
+        self.row_classes = {}
 
         # We store the media, entities and action as blobs, because they're hardly encoded
         # However, we do store the media ID, so we can query, for example, which messages have photos
@@ -57,7 +118,38 @@ class TLDatabase:
         entities blob,              -- 11
 
         action blob,                -- 12
-        action_id integer           -- 13
+        action_id integer,          -- 13
+
+        content_hash integer,       -- 14
+
+        media_size integer,         -- 15
+        media_file_id integer,      -- 16
+        media_mime_type text,       -- 17
+        media_type text,            -- 18
+        media_dc_id integer         -- 19
+        )""")
+
+        # The metadata of the backup (such as where it should be resumed from) is saved
+        # here, so it can be updated in the very same transaction as the messages
+        self.con.execute("""create table if not exists metadata (
+        key text primary key,       -- 0
+        value text                  -- 1
+        )""")
+
+        # The manifest of the media downloaded for every message, so it can be known
+        # what has been downloaded (and where) without probing the file system
+        #
+        # Status is either 'downloaded', 'failed' or 'pending' (if it was interrupted)
+        self.con.execute("""create table if not exists media (
+        msg_id integer primary key, -- 0
+        media_id integer,           -- 1 (the photo or document ID)
+        kind text,                  -- 2 (the media type, such as 'photos' or 'videos')
+        path text,                  -- 3 (relative to the backup directory)
+
+        expected_size integer,      -- 4
+        downloaded_size integer,    -- 5
+        checksum text,              -- 6
+        status text                 -- 7
         )""")
 
         self.con.execute("""create table if not exists users (
@@ -102,6 +194,142 @@ class TLDatabase:
         photo blob                  -- 7
         )""")
 
+        # Bring the schema up to date with the migrations this database lacks
+        self.migrate()
+
+    def apply_storage_profile(self, storage_profile):
+        """Applies the given storage profile (its name or its {pragma: value}) to the connection"""
+        if isinstance(storage_profile, str):
+            if storage_profile not in TLDatabase.storage_profiles:
+                raise ValueError('Unknown storage profile {}'.format(storage_profile))
+            storage_profile = TLDatabase.storage_profiles[storage_profile]
+
+        for pragma, value in storage_profile.items():
+            self.con.execute('pragma {} = {}'.format(pragma, value))
+
+    def get_schema_version(self):
+        """Returns the schema version of the database (how many migrations it has)"""
+        return self.con.execute('pragma user_version').fetchone()[0]
+
+    def migrate(self):
+        """Applies, in order, the migrations the database doesn't have yet.
+           Every migration is idempotent, and the schema version is updated
+           after each of them, so an interrupted migration is simply redone"""
+        version = self.get_schema_version()
+        for version, migration in enumerate(TLDatabase.migrations[version:], start=version + 1):
+            migration(self)
+            self.con.execute('pragma user_version = {}'.format(version))
+            self.con.commit()
+
+    def migrate_content_hash(self):
+        """Migration 1: Adds the content hash of the messages, which older backups
+           didn't store yet. The messages saved before are simply hashed the next
+           time they're replaced"""
+        self.add_missing_column('messages', 'content_hash integer')
+
+    def migrate_media_columns(self):
+        """Migration 2: Adds the columns with the information about the media of the
+           messages, which older backups didn't store in its own columns yet (and
+           which is needed to, for example, sum their sizes without loading every
+           message), filling them for the messages already saved"""
+        for column in ('media_size integer', 'media_file_id integer', 'media_mime_type text',
+                       'media_type text', 'media_dc_id integer'):
+            self.add_missing_column('messages', column)
+
+        # Even if the columns existed, an interrupted migration may have left them half filled
+        self.backfill_media_columns()
+
+        self.con.execute('create index if not exists messages_media_size on messages (media_id, media_size)')
+
+    def migrate_secondary_indexes(self):
+        """Migration 3: Indexes the columns the messages are looked up by, so that,
+           for example, the previous and next days or the media in a date range
+           can be found without scanning the whole table"""
+        self.con.execute('create index if not exists messages_date on messages (date)')
+        self.con.execute('create index if not exists messages_media_date on messages (media_id, date)')
+        self.con.execute('create index if not exists messages_from_id on messages (from_id)')
+        self.con.execute('create index if not exists messages_reply_to_msg_id '
+                         'on messages (reply_to_msg_id)')
+
+    def migrate_message_search(self):
+        """Migration 4: Creates the full-text search index over the message texts
+           (and captions), kept in sync with the messages by triggers, and fills it
+           with the messages already saved. If the SQLite library lacks FTS5, the
+           index isn't created and searching falls back to scanning the messages"""
+        try:
+            self.con.execute("""create virtual table if not exists messages_search
+                                using fts5(message, content='messages', content_rowid='id')""")
+        except sqlite3.OperationalError as e:
+            print('Messages will not be indexed for searching:', e)
+            return
+
+        # Only the messages with text are indexed, so media and service messages cost nothing
+        self.con.execute("""create trigger if not exists messages_search_insert
+                            after insert on messages when new.message is not null begin
+                                insert into messages_search (rowid, message)
+                                values (new.id, new.message);
+                            end""")
+        self.con.execute("""create trigger if not exists messages_search_delete
+                            after delete on messages when old.message is not null begin
+                                insert into messages_search (messages_search, rowid, message)
+                                values ('delete', old.id, old.message);
+                            end""")
+        self.con.execute("""create trigger if not exists messages_search_update
+                            after update of message on messages begin
+                                insert into messages_search (messages_search, rowid, message)
+                                select 'delete', old.id, old.message where old.message is not null;
+                                insert into messages_search (rowid, message)
+                                select new.id, new.message where new.message is not null;
+                            end""")
+
+        # Only the messages with text may be indexed, since the triggers only remove those
+        # from the index (so a FTS5 'rebuild', which indexes every row, can't be used).
+        # The index is emptied first, in case the migration is being redone
+        self.con.execute("insert into messages_search (messages_search) values ('delete-all')")
+        self.con.execute('insert into messages_search (rowid, message) '
+                         'select id, message from messages where message is not null')
+
+    def migrate_empty_gaps(self):
+        """Migration 5: Creates the table of the message gaps which were already requested
+           and came back empty (i.e. the messages were deleted), so they're not requested
+           again every time the gaps are refilled"""
+        self.con.execute('create table if not exists empty_gaps ('
+                         'first_id integer primary key, last_id integer not null)')
+
+    def add_missing_column(self, tablename, column):
+        """Adds the given column definition (i.e. 'name type') to the specified
+           table, only if it doesn't exist already. Returns whether it was added"""
+        name = column.split()[0]
+        columns = [row[1] for row in self.con.execute('pragma table_info({})'.format(tablename))]
+        if name in columns:
+            return False
+
+        self.con.execute('alter table {} add column {}'.format(tablename, column))
+        self.con.commit()
+        return True
+
+    def backfill_media_columns(self, batch_size=1000):
+        """Fills the media columns of the messages saved before these columns existed"""
+        c = self.con.cursor()
+        last_id = None
+        while True:
+            if last_id is None:
+                rows = c.execute('select id, media from messages where media not null '
+                                 'order by id limit ?', (batch_size,)).fetchall()
+            else:
+                rows = c.execute('select id, media from messages where media not null and id > ? '
+                                 'order by id limit ?', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+
+            self.con.executemany('update messages set media_size = ?, media_file_id = ?, '
+                                 'media_mime_type = ?, media_type = ?, media_dc_id = ? where id = ?',
+                                 [self.get_media_columns(self.convert_object(media)) + (msg_id,)
+                                  for msg_id, media in rows])
+            last_id = rows[-1][0]
+
+        self.con.commit()
+
     #endregion
 
     #region Python -> SQL types
@@ -128,6 +356,27 @@ class TLDatabase:
             writer.tgwrite_vector(vector if vector is not None else [])
             return writer.get_bytes()
 
+    @staticmethod
+    def get_media_columns(media):
+        """Returns the (size, file ID, mime type, media type, datacenter ID)
+           tuple of the given message media, which are stored in their own
+           columns so they can be queried without deserializing the media"""
+        if not media:
+            return None, None, None, None, None
+
+        return (MediaHandler.get_media_size(media),
+                MediaHandler.get_media_file_id(media),
+                MediaHandler.get_media_mime_type(media),
+                MediaHandler.get_media_type(media),
+                MediaHandler.get_media_dc_id(media))
+
+    @staticmethod
+    def get_content_hash(row):
+        """Returns a hash of the given sql tuple, as an sql integer, so it can be
+           cheaply told whether a row changed without deserializing its blobs"""
+        digest = sha1(repr(row).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], byteorder='big', signed=True)
+
     #endregion
 
     #region SQL -> Python types
@@ -164,30 +413,14 @@ class TLDatabase:
 
     @staticmethod
     def convert_message(sql_tuple):
-        """Converts an sql tuple back to a message TLObject"""
+        """Converts an sql tuple back to a message TLObject.
+           Its blobs are only decoded once they're accessed (see LazyMessage)"""
 
         # Check whether it is a service message
         if sql_tuple[13]:
-            return MessageService(id=sql_tuple[0],
-                                  from_id=sql_tuple[2],
-                                  out=sql_tuple[3],
-                                  to_id=None,  # This will always be the same, thus it wasn't saved
-                                  date=sql_tuple[4],
-                                  reply_to_msg_id=sql_tuple[8],
-                                  action=TLDatabase.convert_object(sql_tuple[12]))
+            return LazyMessageService(sql_tuple)
         else:
-            return Message(id=sql_tuple[0],
-                           message=sql_tuple[1],
-                           from_id=sql_tuple[2],
-                           to_id=None,  # This will always be the same, thus it wasn't saved
-                           out=sql_tuple[3],
-                           date=sql_tuple[4],
-                           edit_date=sql_tuple[5],
-                           fwd_from=TLDatabase.convert_object(sql_tuple[6]),
-                           via_bot_id=sql_tuple[7],
-                           reply_to_msg_id=sql_tuple[8],
-                           media=TLDatabase.convert_object(sql_tuple[9]),
-                           entities=TLDatabase.convert_vector(sql_tuple[11]))
+            return LazyMessage(sql_tuple)
 
     @staticmethod
     def convert_user(sql_tuple):
@@ -231,43 +464,11 @@ class TLDatabase:
 
     #endregion
 
-    #region Adding objects
-
-    def add_object(self, tlobject, replace=False):
-        """Adds a Telegram object (TLObject) to its corresponding table"""
-
-        if isinstance(tlobject, Message):              # Adding a message
-            self.add_message(tlobject, replace=replace)
-        elif isinstance(tlobject, MessageService):     # Adding a message service
-            self.add_message_service(tlobject, replace=replace)
-
-        elif isinstance(tlobject, User):               # Adding an user
-            self.add_user(tlobject, replace=replace)
-        elif isinstance(tlobject, UserEmpty):          # Adding an empty user
-            self.add_user(tlobject, replace=replace)
-
-        elif isinstance(tlobject, Chat):               # Adding a chat
-            self.add_chat(tlobject, replace=replace)
-        elif isinstance(tlobject, ChatEmpty):          # Adding an empty chat
-            self.add_chat(tlobject, replace=replace)
-        elif isinstance(tlobject, ChatForbidden):      # Adding a forbidden chat
-            self.add_chat(tlobject, replace=replace)
-
-        elif isinstance(tlobject, Channel):            # Adding a channel
-            self.add_channel(tlobject, replace=replace)
-        elif isinstance(tlobject, ChannelForbidden):   # Adding a forbidden channel
-            self.add_channel(tlobject, replace=replace)
-        else:
-            raise ValueError('Unknown type {}'.format(type(tlobject).__name__))
-
-    def add_message(self, msg, replace=False):
-        """Adds a message TLObject to its table"""
-        c = self.con.cursor()
-        if replace:
-            query = 'insert or replace into messages values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-        else:
-            query = 'insert into messages values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+    #region Conversion from TLObjects to SQL tuples
 
+    @staticmethod
+    def get_message_row(msg):
+        """Converts a message TLObject to an sql tuple for the messages table"""
         if msg.message:
             message = msg.message
         elif msg.media:
@@ -278,108 +479,182 @@ class TLDatabase:
         else:
             message = None
 
-        c.execute(query,
-                  (msg.id,
-                   message,
-                   msg.from_id,
-                   msg.out,
-                   msg.date,
-                   msg.edit_date,
-                   self.adapt_object(msg.fwd_from),
-                   msg.via_bot_id,
-                   msg.reply_to_msg_id,
-                   self.adapt_object(msg.media),
-                   type(msg.media).constructor_id if msg.media else None,
-                   self.adapt_vector(msg.entities),
-                   None,
-                   None))
+        row = (msg.id,
+               message,
+               msg.from_id,
+               msg.out,
+               msg.date,
+               msg.edit_date,
+               TLDatabase.adapt_object(msg.fwd_from),
+               msg.via_bot_id,
+               msg.reply_to_msg_id,
+               TLDatabase.adapt_object(msg.media),
+               type(msg.media).constructor_id if msg.media else None,
+               TLDatabase.adapt_vector(msg.entities),
+               None,
+               None)
+        return row + (TLDatabase.get_content_hash(row),) + TLDatabase.get_media_columns(msg.media)
+
+    @staticmethod
+    def get_message_service_row(msg):
+        """Converts a message service TLObject to an sql tuple for the messages table"""
+        row = (msg.id,
+               None,
+               msg.from_id,
+               msg.out,
+               msg.date,
+               None,
+               None,
+               None,
+               msg.reply_to_msg_id,
+               None,
+               None,
+               None,
+               TLDatabase.adapt_object(msg.action),
+               type(msg.action).constructor_id if msg.action else None)
+        return row + (TLDatabase.get_content_hash(row),) + TLDatabase.get_media_columns(None)
+
+    @staticmethod
+    def get_user_row(user):
+        """Converts an user TLObject to an sql tuple for the users table"""
+        if isinstance(user, User):
+            return (user.id,
+                    user.access_hash,
+                    user.is_self,
+                    user.contact,
+                    user.mutual_contact,
+                    user.deleted,
+                    user.bot,
+                    user.first_name,
+                    user.last_name,
+                    user.username,
+                    user.phone,
+                    TLDatabase.adapt_object(user.photo))
+        elif isinstance(user, UserEmpty):
+            return (user.id,
+                    None, None, None, None, None, None, None, None, None, None, None)
+        else:
+            raise ValueError('The user must either be an User or an UserEmpty')
+
+    @staticmethod
+    def get_chat_row(chat):
+        """Converts a chat TLObject to an sql tuple for the chats table"""
+        # We need to use getattr because it may be a ChatEmpty or ChatForbidden
+        return (chat.id,
+                getattr(chat, 'date', None),
+                getattr(chat, 'creator', None),
+                getattr(chat, 'title', None),
+                getattr(chat, 'participants_count', None),
+                TLDatabase.adapt_object(getattr(chat, 'photo', None)))
+
+    @staticmethod
+    def get_channel_row(channel):
+        """Converts a channel TLObject to an sql tuple for the channels table"""
+        # We need to use getattr because it may be a ChannelForbidden
+        return (channel.id,
+                channel.access_hash,
+                getattr(channel, 'megagroup', None),
+                getattr(channel, 'date', None),
+                getattr(channel, 'creator', None),
+                channel.title,
+                getattr(channel, 'username', None),
+                TLDatabase.adapt_object(getattr(channel, 'photo', None)))
+
+    @staticmethod
+    def get_table_and_row(tlobject):
+        """Returns the (table name, sql tuple) pair for the given TLObject"""
+        converter = TLDatabase.row_converters.get(type(tlobject))
+        if not converter:
+            raise ValueError('Unknown type {}'.format(type(tlobject).__name__))
+
+        tablename, convert_function = converter
+        return tablename, convert_function(tlobject)
+
+    #endregion
+
+    #region Adding objects
+
+    @staticmethod
+    def get_insert_query(tablename, row_length, replace=False):
+        """Returns the insert query for the given table and row length"""
+        return 'insert {}into {} values ({})'.format(
+            'or replace ' if replace else '', tablename, ', '.join('?' * row_length))
+
+    def is_row_unchanged(self, tablename, row):
+        """Determines whether the given row was already written through this connection
+           exactly as it is. If it wasn't, its fingerprint is remembered from now on"""
+        if tablename not in TLDatabase.fingerprinted_tables:
+            return False
+
+        key = (tablename, row[0])
+        fingerprint = self.get_content_hash(row)
+        if self.fingerprints.get(key) == fingerprint:
+            self.elided_writes += 1
+            return True
+
+        self.fingerprints[key] = fingerprint
+        return False
+
+    def add_object(self, tlobject, replace=False):
+        """Adds a Telegram object (TLObject) to its corresponding table"""
+        tablename, row = self.get_table_and_row(tlobject)
+        if replace and self.is_row_unchanged(tablename, row):
+            return
+
+        self.con.execute(self.get_insert_query(tablename, len(row), replace=replace), row)
+
+    def add_objects(self, tlobjects, replace=False):
+        """Adds multiple Telegram objects (TLObjects) to their corresponding tables.
+           The rows are grouped by table so each table is written with a single executemany.
+
+           When replacing, the users, chats and channels which were already written
+           through this connection and haven't changed since are not written again"""
+        rows_by_table = {}
+        for tlobject in tlobjects:
+            tablename, row = self.get_table_and_row(tlobject)
+            if replace and self.is_row_unchanged(tablename, row):
+                continue
+            rows_by_table.setdefault(tablename, []).append(row)
+
+        for tablename, rows in rows_by_table.items():
+            self.con.executemany(self.get_insert_query(tablename, len(rows[0]), replace=replace), rows)
+
+    def replace_changed_messages(self, msgs):
+        """Adds the given messages replacing those whose content changed (i.e. they
+           were edited), which is told by their content hash. Unchanged messages are
+           not written at all. Returns how many messages were written"""
+        rows = [self.get_table_and_row(msg)[1] for msg in msgs]
+        hashes = self.get_content_hashes(row[0] for row in rows)
+        changed = [row for row in rows if hashes.get(row[0]) != row[14]]  # 14 is content_hash
+        if changed:
+            self.con.executemany(self.get_insert_query('messages', len(changed[0]), replace=True), changed)
+
+        return len(changed)
+
+    def add_message(self, msg, replace=False):
+        """Adds a message TLObject to its table"""
+        row = self.get_message_row(msg)
+        self.con.execute(self.get_insert_query('messages', len(row), replace=replace), row)
 
     def add_message_service(self, msg, replace=False):
         """Adds a message service TLObject to its table"""
-        c = self.con.cursor()
-        if replace:
-            query = 'insert or replace into messages values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-        else:
-            query = 'insert into messages values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-        c.execute(query,
-                  (msg.id,
-                   None,
-                   msg.from_id,
-                   msg.out,
-                   msg.date,
-                   None,
-                   None,
-                   None,
-                   msg.reply_to_msg_id,
-                   None,
-                   None,
-                   None,
-                   self.adapt_object(msg.action),
-                   type(msg.action).constructor_id if msg.action else None))
+        row = self.get_message_service_row(msg)
+        self.con.execute(self.get_insert_query('messages', len(row), replace=replace), row)
 
     def add_user(self, user, replace=False):
         """Adds an user TLObject to its table"""
-        c = self.con.cursor()
-        if replace:
-            query = 'insert or replace into users values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-        else:
-            query = 'insert into users values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-
-        if isinstance(user, User):
-            c.execute(query,
-                      (user.id,
-                       user.access_hash,
-                       user.is_self,
-                       user.contact,
-                       user.mutual_contact,
-                       user.deleted,
-                       user.bot,
-                       user.first_name,
-                       user.last_name,
-                       user.username,
-                       user.phone,
-                       self.adapt_object(user.photo)))
-        elif isinstance(user, UserEmpty):
-            c.execute(query, (user.id,
-                              None, None, None, None, None, None, None, None, None, None, None))
-        else:
-            raise  ValueError('The user must either be an User or an UserEmpty')
+        row = self.get_user_row(user)
+        self.con.execute(self.get_insert_query('users', len(row), replace=replace), row)
 
     def add_chat(self, chat, replace=False):
         """Adds a chat TLObject to its table"""
-        c = self.con.cursor()
-        if replace:
-            query = 'insert or replace into chats values (?, ?, ?, ?, ?, ?)'
-        else:
-            query = 'insert into chats values (?, ?, ?, ?, ?, ?)'
-
-        # We need to use getattr because it may be a ChatEmpty or ChatForbidden
-        c.execute(query,
-                  (chat.id,
-                   getattr(chat, 'date', None),
-                   getattr(chat, 'creator', None),
-                   getattr(chat, 'title', None),
-                   getattr(chat, 'participants_count', None),
-                   self.adapt_object(getattr(chat, 'photo', None))))
+        row = self.get_chat_row(chat)
+        self.con.execute(self.get_insert_query('chats', len(row), replace=replace), row)
 
     def add_channel(self, channel, replace=False):
         """Adds a channel TLObject to its table"""
-        c = self.con.cursor()
-        if replace:
-            query = 'insert or replace into channels values (?, ?, ?, ?, ?, ?, ?, ?)'
-        else:
-            query = 'insert into channels values (?, ?, ?, ?, ?, ?, ?, ?)'
-
-        # We need to use getattr because it may be a ChannelForbidden
-        c.execute(query,
-                  (channel.id,
-                   channel.access_hash,
-                   getattr(channel, 'megagroup', None),
-                   getattr(channel, 'date', None),
-                   getattr(channel, 'creator', None),
-                   channel.title,
-                   getattr(channel, 'username', None),
-                   self.adapt_object(getattr(channel, 'photo', None))))
+        row = self.get_channel_row(channel)
+        self.con.execute(self.get_insert_query('channels', len(row), replace=replace), row)
 
     #endregion
 
@@ -390,6 +665,17 @@ class TLDatabase:
         c = self.con.cursor()
         return c.execute('select count(*) from {}'.format(tablename)).fetchone()[0]
 
+    def sum_column(self, column, tablename):
+        """Returns the sum of the given column in the specified table, or 0 if it's empty.
+           Much like count, the table name may be followed by a query (i.e. `where ...`)"""
+        c = self.con.cursor()
+        return c.execute('select sum({}) from {}'.format(column, tablename)).fetchone()[0] or 0
+
+    def get_max_id(self, tablename):
+        """Returns the highest ID in the specified table, or 0 if it's empty"""
+        c = self.con.cursor()
+        return c.execute('select max(id) from {}'.format(tablename)).fetchone()[0] or 0
+
     #endregion
 
     #region In table
@@ -400,6 +686,136 @@ class TLDatabase:
         item_id = c.execute('select id from {} where id=?'.format(tablename), (tlobject_id,)).fetchone()
         return item_id is not None
 
+    def which_in_table(self, tlobject_ids, tablename):
+        """Determines which of the given TLObject IDs are in the specified table,
+           returning them as a set. A single query is issued per batch of IDs"""
+        found = set()
+        tlobject_ids = list(tlobject_ids)
+        c = self.con.cursor()
+        for i in range(0, len(tlobject_ids), TLDatabase.max_query_params):
+            batch = tlobject_ids[i:i + TLDatabase.max_query_params]
+            c.execute('select id from {} where id in ({})'
+                      .format(tablename, ', '.join('?' * len(batch))), batch)
+            found.update(row[0] for row in c)
+
+        return found
+
+    def get_content_hashes(self, msg_ids):
+        """Returns a {message ID: content hash} dictionary for those of the given
+           message IDs which are in the messages table"""
+        hashes = {}
+        msg_ids = list(msg_ids)
+        c = self.con.cursor()
+        for i in range(0, len(msg_ids), TLDatabase.max_query_params):
+            batch = msg_ids[i:i + TLDatabase.max_query_params]
+            c.execute('select id, content_hash from messages where id in ({})'
+                      .format(', '.join('?' * len(batch))), batch)
+            hashes.update(c)
+
+        return hashes
+
+    #endregion
+
+    #region Metadata
+
+    def get_metadata(self):
+        """Returns the metadata stored in the database as a dictionary"""
+        c = self.con.cursor()
+        return {key: json.loads(value) for key, value in c.execute('select key, value from metadata')}
+
+    def set_metadata(self, metadata):
+        """Stores the given metadata dictionary in the database.
+           The changes are not committed, so they're part of the current transaction"""
+        self.con.executemany('insert or replace into metadata values (?, ?)',
+                             ((key, json.dumps(value)) for key, value in metadata.items()))
+
+    #endregion
+
+    #region Media manifest
+
+    def set_media(self, msg_id, media_id, kind, relative_path,
+                  expected_size, downloaded_size, checksum, status):
+        """Sets the manifest entry for the media of the given message ID"""
+        self.con.execute('insert or replace into media values (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (msg_id, media_id, kind, relative_path,
+                          expected_size, downloaded_size, checksum, status))
+
+    def get_downloaded_media(self):
+        """Returns a {message ID: relative path} dictionary with all the downloaded media"""
+        c = self.con.cursor()
+        return dict(c.execute("select msg_id, path from media where status = 'downloaded'"))
+
+    #endregion
+
+    #region Gaps
+
+    def find_gaps(self, tablename='messages', skip_empty=False):
+        """Finds which ranges of IDs are missing between the lowest and the highest
+           ID in the specified table, returning a list of inclusive (first, last) tuples.
+           If skip_empty is True, the gaps within those marked as empty are left out.
+
+           Note that for users and chats (unlike channels), message IDs are shared
+           between all the dialogs, so gaps do not necessarily mean missing messages"""
+        c = self.con.cursor()
+        query = '''select previous_id + 1, id - 1 from (
+                       select id, lag(id) over (order by id) as previous_id from {}
+                   ) where id - previous_id > 1'''.format(tablename)
+        if skip_empty:
+            query += ''' and not exists (select 1 from empty_gaps
+                                         where first_id <= previous_id + 1 and last_id >= id - 1)'''
+        return c.execute(query + ' order by id').fetchall()
+
+    def add_empty_gap(self, first_id, last_id):
+        """Marks the given inclusive range of message IDs as already requested, with
+           nothing (else) found in it, so it can be skipped when looking for gaps"""
+        self.con.execute('insert or replace into empty_gaps (first_id, last_id) values (?, ?)',
+                         (first_id, last_id))
+
+    #endregion
+
+    #region Searching
+
+    def is_searchable(self):
+        """Determines whether the database has a full-text search index"""
+        return self.con.execute("select count(*) from sqlite_master "
+                                "where name = 'messages_search'").fetchone()[0] > 0
+
+    def search(self, text, from_id=None, after_date=None, before_date=None, limit=50, offset=0):
+        """Searches the messages (and captions) matching the given text, and yields
+           them from the most relevant to the least. The text follows the FTS5 query
+           syntax (so, for example, `"exact phrase"` or `word*` can be used).
+
+           The results can be filtered by sender and date, and paged through
+           with the limit (how many at most) and the offset (how many to skip)"""
+        if self.is_searchable():
+            query = 'select messages.* from messages_search join messages ' \
+                    'on messages.id = messages_search.rowid where messages_search match ?'
+            order = 'messages_search.rank'
+            params = [text]
+        else:
+            # Without a search index, the best we can do is to look for the text as is
+            query = "select * from messages where message like ? escape '\\'"
+            order = 'date desc'
+            params = ['%{}%'.format(text.replace('\\', '\\\\')
+                                    .replace('%', '\\%').replace('_', '\\_'))]
+
+        if from_id is not None:
+            query += ' and from_id = ?'
+            params.append(from_id)
+        if after_date:
+            query += ' and date >= ?'
+            params.append(after_date)
+        if before_date:
+            query += ' and date <= ?'
+            params.append(before_date)
+
+        query += ' order by {} limit ? offset ?'.format(order)
+        params.extend((limit, offset))
+
+        c = self.con.cursor()
+        for item in c.execute(query, params):
+            yield self.convert_message(item)
+
     #endregion
 
     #region Querying
@@ -429,6 +845,102 @@ class TLDatabase:
         for item in c.execute('select * from {} {}'.format(tablename, query)):
             yield convert_function(item)
 
+    def query_rows(self, query):
+        """Yields the raw tuples returned by the given (full) query.
+           Query example: `select id, date from messages order by id asc`"""
+        return self.fetch_batches(self.con.cursor().execute(query))
+
+    @staticmethod
+    def fetch_batches(cursor, batch_size=None):
+        """Yields all the rows of the given executed cursor, fetching them in batches"""
+        batch_size = batch_size if batch_size else TLDatabase.fetch_batch_size
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+    #endregion
+
+    #region Projecting
+
+    def select(self, tablename, columns, filters=(), order_by=(), limit=None, batch_size=None):
+        """Yields only the given columns of the rows in the specified table, as compact
+           named tuples, without converting them to TLObjects. The rows are fetched
+           in batches, so huge tables can be walked without loading them at once.
+
+           The filters are (column, operator, value) tuples which must all match
+           (the value of 'in' and 'not in' being a list), and the ordering is given
+           as a list of column names or (column, 'asc' or 'desc') tuples.
+
+           Example: `select('messages', ('id', 'date'), [('date', '>=', after_date)],
+                            order_by=[('date', 'desc')], limit=10)`"""
+        columns = tuple(columns)
+        for column in columns:
+            self.check_column(tablename, column)
+
+        query = 'select {} from {}'.format(', '.join(columns), tablename)
+        params = []
+        conditions = []
+        for column, operator, value in filters:
+            self.check_column(tablename, column)
+            operator = operator.lower()
+            if operator not in TLDatabase.filter_operators:
+                raise ValueError('Unknown filter operator {}'.format(operator))
+
+            if operator in ('in', 'not in'):
+                value = list(value)
+                conditions.append('{} {} ({})'.format(column, operator, ', '.join('?' * len(value))))
+                params.extend(value)
+            else:
+                conditions.append('{} {} ?'.format(column, operator))
+                params.append(value)
+
+        if conditions:
+            query += ' where ' + ' and '.join(conditions)
+
+        orderings = []
+        for ordering in order_by:
+            column, direction = (ordering, 'asc') if isinstance(ordering, str) else ordering
+            self.check_column(tablename, column)
+            if direction.lower() not in ('asc', 'desc'):
+                raise ValueError('Unknown ordering direction {}'.format(direction))
+            orderings.append('{} {}'.format(column, direction))
+
+        if orderings:
+            query += ' order by ' + ', '.join(orderings)
+
+        if limit is not None:
+            query += ' limit ?'
+            params.append(limit)
+
+        row_class = self.get_row_class(columns)
+        for row in self.fetch_batches(self.con.cursor().execute(query, params), batch_size):
+            yield row_class._make(row)
+
+    def select_one(self, tablename, columns, filters=(), order_by=()):
+        """Returns the first row yielded by select() for the given parameters, or None"""
+        for row in self.select(tablename, columns, filters, order_by, limit=1):
+            return row
+
+    def check_column(self, tablename, column):
+        """Ensures that the specified table has the given column, raising ValueError otherwise"""
+        if tablename not in self.table_columns:
+            self.table_columns[tablename] = {row[1] for row in
+                                             self.con.execute('pragma table_info({})'.format(tablename))}
+            if not self.table_columns[tablename]:
+                del self.table_columns[tablename]
+                raise ValueError('Unknown table {}'.format(tablename))
+
+        if column not in self.table_columns[tablename]:
+            raise ValueError('Unknown column {} in table {}'.format(column, tablename))
+
+    def get_row_class(self, columns):
+        """Returns the named tuple class used for the rows with the given columns"""
+        if columns not in self.row_classes:
+            self.row_classes[columns] = namedtuple('Row', columns)
+        return self.row_classes[columns]
+
     #endregion
 
     #region Querying single
@@ -464,6 +976,12 @@ class TLDatabase:
         """Commit changes to the database"""
         self.con.commit()
 
+    def rollback(self):
+        """Rolls back the changes made since the last commit"""
+        self.con.rollback()
+        # The rows we remember may have been rolled back too
+        self.fingerprints.clear()
+
     def close(self):
         self.con.close()
 
@@ -476,3 +994,106 @@ class TLDatabase:
         self.close()
 
     #endregion
+
+
+class LazyBlob:
+    """Attribute of a message converted from an sql tuple, which is only decoded
+       from the blob at the given index of the tuple when it's first accessed.
+       The decoded value replaces the attribute, so it's decoded only once"""
+
+    def __init__(self, index, convert_function):
+        self.index = index
+        self.convert_function = convert_function
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        value = self.convert_function(instance.sql_tuple[self.index])
+        instance.__dict__[self.name] = value
+        return value
+
+    @staticmethod
+    def forget(instance):
+        """Forgets the values assigned to the lazy attributes of the given instance
+           (i.e. by its constructor), so they're decoded when accessed instead"""
+        for name, attribute in vars(type(instance)).items():
+            if isinstance(attribute, LazyBlob):
+                instance.__dict__.pop(name, None)
+
+
+class LazyMessage(Message):
+    """Message converted from an sql tuple, whose forward header, media and entities
+       are only decoded when they're first accessed. Most passes over the messages
+       (i.e. to find their dates) don't need them at all"""
+
+    fwd_from = LazyBlob(6, TLDatabase.convert_object)
+    media = LazyBlob(9, TLDatabase.convert_object)
+    entities = LazyBlob(11, TLDatabase.convert_vector)
+
+    def __init__(self, sql_tuple):
+        super().__init__(id=sql_tuple[0],
+                         message=sql_tuple[1],
+                         from_id=sql_tuple[2],
+                         to_id=None,  # This will always be the same, thus it wasn't saved
+                         out=sql_tuple[3],
+                         date=sql_tuple[4],
+                         edit_date=sql_tuple[5],
+                         via_bot_id=sql_tuple[7],
+                         reply_to_msg_id=sql_tuple[8])
+        self.sql_tuple = sql_tuple
+        LazyBlob.forget(self)
+
+
+class LazyMessageService(MessageService):
+    """MessageService converted from an sql tuple, whose action
+       is only decoded when it's first accessed"""
+
+    action = LazyBlob(12, TLDatabase.convert_object)
+
+    def __init__(self, sql_tuple):
+        super().__init__(id=sql_tuple[0],
+                         from_id=sql_tuple[2],
+                         out=sql_tuple[3],
+                         to_id=None,  # This will always be the same, thus it wasn't saved
+                         date=sql_tuple[4],
+                         reply_to_msg_id=sql_tuple[8],
+                         action=None)
+        self.sql_tuple = sql_tuple
+        LazyBlob.forget(self)
+
+
+# Which table and which conversion function should be used for every TLObject type.
+# Looking the exact type up is cheaper than walking an isinstance chain per object
+TLDatabase.row_converters = {
+    Message: ('messages', TLDatabase.get_message_row),
+    MessageService: ('messages', TLDatabase.get_message_service_row),
+    LazyMessage: ('messages', TLDatabase.get_message_row),
+    LazyMessageService: ('messages', TLDatabase.get_message_service_row),
+
+    User: ('users', TLDatabase.get_user_row),
+    UserEmpty: ('users', TLDatabase.get_user_row),
+
+    Chat: ('chats', TLDatabase.get_chat_row),
+    ChatEmpty: ('chats', TLDatabase.get_chat_row),
+    ChatForbidden: ('chats', TLDatabase.get_chat_row),
+
+    Channel: ('channels', TLDatabase.get_channel_row),
+    ChannelForbidden: ('channels', TLDatabase.get_channel_row),
+}
+
+
+# The schema migrations, in order. Every database stores (as its user_version) how many
+# of them it already has, so the new ones are applied the next time it's opened.
+# New migrations must always be appended, and must be safe to run more than once
+TLDatabase.migrations = (
+    TLDatabase.migrate_content_hash,
+    TLDatabase.migrate_media_columns,
+    TLDatabase.migrate_secondary_indexes,
+    TLDatabase.migrate_message_search,
+    TLDatabase.migrate_empty_gaps,
+)